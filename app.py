@@ -1,11 +1,23 @@
+import click
+import hashlib
+import importlib
+import itertools
 import os
-from flask import Flask, render_template, jsonify, request, abort
+import uuid
+from flask import Flask, Request, Response, render_template, jsonify, \
+    request, abort
 from flask_cors import CORS
-from image_control import ImageControl
-from auth import AuthError, requires_auth
-from models import setup_db, create_all, Album, Image
+from image_control import ImageControl, HashingFile, SIGNED_URLS, \
+    signed_url_epoch
+from auth import AuthError, requires_auth, check_permissions, jwks_store, \
+    token_cache
+from cache import ResponseCache, conditional
+from serialization import json_response, stream_json_response
+from similarity import SimilarityIndex, popcount_table
+import metrics
+from models import setup_db, create_all, Album, Image, UploadJob
 from sqlalchemy import asc
-from flask_migrate import Migrate
+from sqlalchemy.exc import IntegrityError
 
 NO_FILE_IN_UPLOAD_REQUEST_MESSAGE = "There was no file in upload request"
 NO_NAME_IN_CREATE_ALBUM_REQUEST_MESSAGE = "There was no file in upload request"
@@ -15,17 +27,135 @@ NO_ALBUMS_TO_SHOW_MESSAGE = "No albums to show"
 NO_IMAGES_TO_SHOW_MESSAGE = "No images to show"
 NO_ALBUM_FOUND_MESSAGE = "No album found"
 NO_IMAGE_FOUND_MESSAGE = "No image found"
+NO_UPLOAD_JOB_FOUND_MESSAGE = "No upload job found"
 IMAGEKIT_EXCEPTION_MESSAGE = "Something went wrong in imagekit"
+TOO_MANY_FILES_IN_UPLOAD_REQUEST_MESSAGE = "There were too many files \
+    in upload request"
+INVALID_PAGINATION_MESSAGE = "Invalid pagination arguments"
+INVALID_INCLUDE_MESSAGE = "Invalid include arguments"
+INVALID_SIMILAR_IMAGES_MESSAGE = "Invalid similar images arguments"
+NO_PERCEPTUAL_HASH_MESSAGE = "The image has no perceptual hash"
+INVALID_BATCH_OPERATIONS_MESSAGE = "Invalid batch operations"
+INVALID_IMAGE_IDS_MESSAGE = "Invalid image ids"
+TOO_MANY_IMAGE_IDS_MESSAGE = "There were too many image ids \
+    in delete request"
+TOO_MANY_BATCH_OPERATIONS_MESSAGE = "There were too many operations \
+    in batch request"
+DUPLICATE_DELETED_MESSAGE = "The stored image with the same content was \
+    deleted during the upload"
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+DEFAULT_IMAGES_PER_ALBUM = int(os.environ.get('DEFAULT_IMAGES_PER_ALBUM', 20))
+# Rows read and encoded at a time by the unpaginated listings
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 1000))
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+MAX_BATCH_UPLOAD_FILES = int(os.environ.get('MAX_BATCH_UPLOAD_FILES', 100))
+# Times a batch is saved again after losing a race to a concurrent upload
+# of the same content
+BATCH_UPLOAD_SAVE_ATTEMPTS = 3
+MAX_BATCH_ALBUM_OPERATIONS = int(
+    os.environ.get('MAX_BATCH_ALBUM_OPERATIONS', 100))
+MAX_BATCH_DELETE_IMAGES = int(os.environ.get('MAX_BATCH_DELETE_IMAGES', 1000))
+# Bits two perceptual hashes can differ in to be near-duplicates
+SIMILAR_MAX_DISTANCE = int(os.environ.get('SIMILAR_MAX_DISTANCE', 10))
+SIMILAR_MAX_RESULTS = int(os.environ.get('SIMILAR_MAX_RESULTS', 100))
+SIMILARITY_INDEX_ALBUMS = int(os.environ.get('SIMILARITY_INDEX_ALBUMS', 64))
+# Must be in the same disk as the worker that processes the upload jobs
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR', '/tmp/upload_spool')
+# Loaded on first use, warm_up loads them before the first request
+LAZY_MODULES = ('numpy', 'jose.jwt', 'requests_toolbelt', 'PIL.Image')
+
+
+class UploadRequest(Request):
+    '''
+    Hashes the uploaded files while werkzeug spools them, so duplicates
+    are detected without reading them again
+    '''
+    def _get_file_stream(self, *args, **kwargs):
+        return HashingFile(super()._get_file_stream(*args, **kwargs))
+
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 db = setup_db(app)
-migrate = Migrate(app, db)
+# Flask-Migrate imports alembic, only the flask command line (flask db)
+# needs it
+if os.environ.get('FLASK_RUN_FROM_CLI') == 'true':
+    from flask_migrate import Migrate
+    migrate = Migrate(app, db)
 CORS(app)
+metrics.instrument(app)
 
 # with app.app_context():
 #     create_all()
 
 ik = ImageControl()
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
+similarity_index = SimilarityIndex(SIMILARITY_INDEX_ALBUMS)
+
+ALBUMS_CACHE_TAG = 'albums'
+# Permission of every operation of POST /albums/batch
+ALBUM_OPERATION_PERMISSIONS = {
+    'create': 'post:albums',
+    'rename': 'patch:albums',
+    'delete': 'delete:albums',
+}
+
+
+def warm_up():
+    '''
+    Loads what importing the app leaves for the first requests: the lazy
+    modules, the storage client and the Auth0 signing keys. gunicorn
+    runs it in the preloaded master, so the workers share them.
+    '''
+    for name in LAZY_MODULES:
+        importlib.import_module(name)
+    ik.storage
+    popcount_table()
+    jwks_store.prefetch()
+
+
+def after_fork():
+    '''
+    Run by gunicorn in every worker forked from the preloaded master,
+    connections and metrics of the master are not shared
+    '''
+    with app.app_context():
+        db.engine.dispose(close=False)
+    metrics.registry.reset()
+
+
+def album_cache_tag(albumId):
+    return 'album:{0}'.format(albumId)
+
+
+def albums_etag():
+    '''
+    Hash of the (id, version) of the albums of the requested page and of
+    its next_cursor, only all=true reads every album
+    '''
+    try:
+        after, limit = get_page_arguments()
+    except Exception:
+        # The view answers the invalid arguments
+        return 'invalid'
+    versions = paginate(
+        db.select(Album.id, Album.version), Album.id, after, limit)
+    if SIGNED_URLS:
+        # The signed urls of the included images change every epoch
+        versions = (versions, signed_url_epoch())
+    return hashlib.sha1(repr(versions).encode()).hexdigest()
+
+
+def album_images_etag(albumId):
+    version = db.session.query(Album.version).filter_by(id=albumId).scalar()
+    if SIGNED_URLS:
+        # The signed urls of the srcsets change every epoch
+        return '{0}-{1}-{2}'.format(albumId, version, signed_url_epoch())
+    return '{0}-{1}'.format(albumId, version)
 
 
 @app.route("/")
@@ -38,26 +168,191 @@ def hello_world():
         )
 
 
+def get_page_arguments():
+    '''
+    Reads the keyset pagination arguments from the query string.
+    after is the id of the last row already received (None for the first
+    page). With all=true the listing is returned unpaginated and limit
+    is None.
+    '''
+    try:
+        after = request.args.get('after', None)
+        after = int(after) if after is not None else None
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise Exception(INVALID_PAGINATION_MESSAGE)
+    if (after is not None and after < 0) or limit < 1:
+        raise Exception(INVALID_PAGINATION_MESSAGE)
+    if request.args.get('all', 'false').lower() == 'true':
+        return after, None
+    return after, min(limit, MAX_PAGE_SIZE)
+
+
+def image_data(image, srcset=False):
+    '''
+    getData() of a row of Image.data_columns(), with the srcset of its
+    resized copies when the listing is requested with srcset=true
+    '''
+    data = Image.rowData(image)
+    if srcset:
+        data["srcset"] = ik.srcset(image.imageKitId, image.url, image.w)
+    return data
+
+
+def paginate(statement, column, after, limit):
+    '''
+    Returns the rows of the page ordered by column, the id, and the
+    cursor of the next page, None when there are no more rows.
+    statement is a Core select run in the connection of the session, so
+    the rows are plain tuples instead of ORM objects that would be
+    hydrated and tracked by the session.
+    '''
+    connection = db.session.connection()
+    if after is not None:
+        statement = statement.where(column > after)
+    statement = statement.order_by(asc(column))
+    if limit is None:
+        return connection.execute(statement).all(), None
+    rows = connection.execute(statement.limit(limit + 1)).all()
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+def stream_listing(statement, column, after, key, data, emptyMessage):
+    '''
+    Streams an unpaginated listing (all=true) ordered by column. Rows are
+    read with a server side cursor and encoded in chunks of
+    STREAM_CHUNK_SIZE, data converts a row to its JSON object.
+    emptyMessage is raised when there are no rows at all.
+    '''
+    if after is not None:
+        statement = statement.where(column > after)
+    statement = statement.order_by(asc(column))
+    statement = statement.execution_options(yield_per=STREAM_CHUNK_SIZE)
+    partitions = db.session.connection().execute(statement).partitions()
+    first = next(partitions, [])
+    if len(first) == 0 and after is None:
+        raise Exception(emptyMessage)
+    chunks = (
+        [data(row) for row in chunk]
+        for chunk in itertools.chain([first], partitions)
+    )
+    return stream_json_response(
+        {"success": True, "next_cursor": None}, key, chunks)
+
+
 @app.route("/albums/<int:albumId>/images")
+@conditional(album_images_etag)
+@response_cache.cached(lambda albumId: [album_cache_tag(albumId)])
 def get_images(albumId):
     try:
-        query = Image.query.filter_by(albumId=albumId)
-        query = query.order_by(asc(Image.id))
-        images = [image.getData() for image in query.all()]
-        if len(images) == 0:
+        after, limit = get_page_arguments()
+        srcset = request.args.get('srcset', 'false').lower() == 'true'
+        statement = db.select(*Image.data_columns()).where(
+            Image.albumId == albumId)
+        if limit is None:
+            return stream_listing(
+                statement,
+                Image.id,
+                after,
+                "images",
+                lambda row: image_data(row, srcset),
+                NO_IMAGES_TO_SHOW_MESSAGE
+            )
+        rows, next_cursor = paginate(statement, Image.id, after, limit)
+        images = [image_data(row, srcset) for row in rows]
+        if len(images) == 0 and after is None:
             raise Exception(NO_IMAGES_TO_SHOW_MESSAGE)
-        return jsonify({
+        return json_response({
                 "success": True,
                 "images": images,
+                "next_cursor": next_cursor,
             })
     except Exception as e:
         print("\nEXCEPTION get_images", e, end='\n\n')
-        if e.__str__() == NO_IMAGES_TO_SHOW_MESSAGE:
+        if e.__str__() in [
+                NO_IMAGES_TO_SHOW_MESSAGE, INVALID_PAGINATION_MESSAGE]:
             abort(400)
         else:
             abort(422)
 
 
+def get_album_index(albumId):
+    '''
+    Returns the similarity index of the album at its current version,
+    None if the album does not exist
+    '''
+    version = db.session.query(Album.version).filter_by(id=albumId).scalar()
+    if version is None:
+        return None
+    return similarity_index.get(
+        albumId, version, lambda: Image.perceptual_hashes(albumId))
+
+
+def find_similar_images(image, maxDistance=SIMILAR_MAX_DISTANCE,
+                        limit=SIMILAR_MAX_RESULTS):
+    '''
+    (imageId, distance) of the near-duplicates of the image in its album
+    '''
+    if image.perceptualHash is None:
+        return []
+    index = get_album_index(image.albumId)
+    if index is None:
+        return []
+    return index.search(
+        image.perceptualHash, maxDistance, limit, exclude=image.id)
+
+
+@app.route("/albums/<int:albumId>/images/similar")
+@conditional(album_images_etag)
+@response_cache.cached(lambda albumId: [album_cache_tag(albumId)])
+def get_similar_images(albumId):
+    try:
+        try:
+            imageId = int(request.args['imageId'])
+            maxDistance = int(request.args.get(
+                'maxDistance', SIMILAR_MAX_DISTANCE))
+            limit = int(request.args.get('limit', SIMILAR_MAX_RESULTS))
+        except (KeyError, ValueError):
+            raise Exception(INVALID_SIMILAR_IMAGES_MESSAGE)
+        if not 0 <= maxDistance <= 64 or limit < 1:
+            raise Exception(INVALID_SIMILAR_IMAGES_MESSAGE)
+        image = Image.query.filter_by(id=imageId, albumId=albumId).first()
+        if image is None:
+            raise Exception(NO_IMAGE_FOUND_MESSAGE)
+        if image.perceptualHash is None:
+            raise Exception(NO_PERCEPTUAL_HASH_MESSAGE)
+        matches = find_similar_images(
+            image, maxDistance, min(limit, SIMILAR_MAX_RESULTS))
+        rows = db.session.connection().execute(
+            db.select(*Image.data_columns()).where(
+                Image.id.in_([imageId for imageId, _ in matches]))
+        ).all()
+        rows = {row.id: row for row in rows}
+        srcset = request.args.get('srcset', 'false').lower() == 'true'
+        images = []
+        for imageId, distance in matches:
+            # Deleted since the index was loaded
+            if imageId not in rows:
+                continue
+            data = image_data(rows[imageId], srcset)
+            data["distance"] = distance
+            images.append(data)
+        return json_response({
+                "success": True,
+                "images": images,
+            })
+    except Exception as e:
+        print("\nEXCEPTION get_similar_images", e, end='\n\n')
+        if e.__str__() == INVALID_SIMILAR_IMAGES_MESSAGE:
+            abort(400)
+        elif e.__str__() == NO_IMAGE_FOUND_MESSAGE:
+            abort(404)
+        else:
+            abort(422)
+
+
 @app.route("/images/<int:imageId>", methods=["DELETE"])
 @requires_auth('delete:images')
 def delete_image(payload, imageId):
@@ -66,12 +361,19 @@ def delete_image(payload, imageId):
         if image is None:
             raise Exception(NO_IMAGE_FOUND_MESSAGE)
         imageKitId = image.imageKitId
-        try:
-            ik.delete_image(imageKitId)
-        except Exception as e:
-            print("\nIMAGEKIT_EXCEPTION upload_image", e, end='\n\n')
-            raise Exception(IMAGEKIT_EXCEPTION_MESSAGE)
+        albumId = image.albumId
+        # Images with the same content share the imagekit file, it is
+        # deleted with the last of them
+        if Image.count_references(imageKitId) == 1:
+            try:
+                ik.delete_image(imageKitId)
+            except Exception as e:
+                print("\nIMAGEKIT_EXCEPTION upload_image", e, end='\n\n')
+                raise Exception(IMAGEKIT_EXCEPTION_MESSAGE)
+        version = Album.bump_version(albumId)
         image.delete()
+        response_cache.invalidate(album_cache_tag(albumId))
+        similarity_index.update(albumId, version, removed=[imageId])
         return jsonify({
                 "success": True,
                 "delete": imageId,
@@ -85,6 +387,204 @@ def delete_image(payload, imageId):
             abort(422)
 
 
+@app.route("/images", methods=["DELETE"])
+@requires_auth('delete:images')
+def delete_images(payload):
+    '''
+    Deletes many images with a bulk request to imagekit for every
+    BULK_DELETE_MAX_FILES files, and a single statement for the rows.
+    Images whose file could not be deleted are kept.
+    '''
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or \
+                not isinstance(data.get('imageIds'), list) or \
+                len(data['imageIds']) == 0 or \
+                any(type(imageId) is not int for imageId in data['imageIds']):
+            raise Exception(INVALID_IMAGE_IDS_MESSAGE)
+        imageIds = list(dict.fromkeys(data['imageIds']))
+        if len(imageIds) > MAX_BATCH_DELETE_IMAGES:
+            raise Exception(TOO_MANY_IMAGE_IDS_MESSAGE)
+
+        requested = set(imageIds)
+        images = {}
+        # Images with the same content share the imagekit file, it is
+        # deleted with the last of them
+        sharedFiles = set()
+        for imageId, imageKitId, albumId in Image.sharing_files(imageIds):
+            if imageId in requested:
+                images[imageId] = (imageKitId, albumId)
+            else:
+                sharedFiles.add(imageKitId)
+        imageKitIds = list({
+            imageKitId for imageKitId, _ in images.values()
+            if imageKitId not in sharedFiles
+        })
+        response = ik.bulk_delete_images(imageKitIds)
+        if not response['success']:
+            print("\nIMAGEKIT_EXCEPTION delete_images", response['message'],
+                  end='\n\n')
+        deleted = sharedFiles.union(response['deleted'])
+
+        removed = {}
+        for imageId, (imageKitId, albumId) in images.items():
+            if imageKitId in deleted:
+                removed.setdefault(albumId, []).append(imageId)
+        if len(removed) > 0:
+            versions = Album.bump_versions(
+                [albumId for albumId in removed if albumId is not None])
+            Image.delete_all([
+                imageId for ids in removed.values() for imageId in ids])
+        db.session.commit()
+        for albumId, ids in removed.items():
+            if albumId is not None:
+                response_cache.invalidate(album_cache_tag(albumId))
+                similarity_index.update(
+                    albumId, versions[albumId], removed=ids)
+
+        results = []
+        for imageId in imageIds:
+            result = {"id": imageId, "success": False}
+            if imageId not in images:
+                result["error"] = 404
+                result["message"] = NO_IMAGE_FOUND_MESSAGE
+            elif images[imageId][0] not in deleted:
+                result["error"] = 422
+                result["message"] = IMAGEKIT_EXCEPTION_MESSAGE
+            else:
+                result["success"] = True
+            results.append(result)
+        return jsonify({
+                "success": True,
+                "delete": [result["id"] for result in results
+                           if result["success"]],
+                "results": results,
+            })
+
+    except Exception as e:
+        print("\nEXCEPTION delete_images", e, end='\n\n')
+        db.session.rollback()
+        if e.__str__() in [
+                INVALID_IMAGE_IDS_MESSAGE, TOO_MANY_IMAGE_IDS_MESSAGE]:
+            abort(400)
+        else:
+            abort(422)
+
+
+def enqueue_upload(file, albumId, contentHash=None):
+    '''
+    Saves the file in the spool directory and records a pending job,
+    the worker (python manage.py worker) uploads it to imagekit later
+    '''
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(UPLOAD_SPOOL_DIR, uuid.uuid4().hex)
+    file.save(path)
+    try:
+        job = UploadJob(
+            albumId=albumId,
+            path=path,
+            fileName=file.filename,
+            contentHash=contentHash
+        )
+        job.insert()
+    except Exception:
+        os.remove(path)
+        raise
+    return job
+
+
+@app.route("/uploads/<int:jobId>")
+@requires_auth('post:images')
+def get_upload_job(payload, jobId):
+    try:
+        job = UploadJob.query.filter_by(id=jobId).first()
+        if job is None:
+            raise Exception(NO_UPLOAD_JOB_FOUND_MESSAGE)
+        data = job.getData()
+        if job.imageId is not None:
+            image = Image.query.filter_by(id=job.imageId).first()
+            data["image"] = image.getData() if image is not None else None
+        return jsonify({
+                "success": True,
+                "jobs": [data],
+            })
+    except Exception as e:
+        print("\nEXCEPTION get_upload_job", e, end='\n\n')
+        if e.__str__() == NO_UPLOAD_JOB_FOUND_MESSAGE:
+            abort(404)
+        else:
+            abort(422)
+
+
+def delete_unreferenced_file(imageKitId):
+    '''
+    Deletes the file of an image that was rolled back, unless other images
+    use it: the filesystem storage names the files by their content
+    '''
+    references = Image.count_references(imageKitId)
+    # No connection is held while the storage deletes the file
+    db.session.rollback()
+    if references == 0:
+        ik.delete_image(imageKitId)
+
+
+def save_batch(albumId, hashes, uploaded):
+    '''
+    Saves the images of a batch in a short transaction. Every content hash
+    gets the duplicate stored meanwhile, or else the image of its
+    successful upload in uploaded. Returns the image of every saved hash,
+    the hashes saved as duplicates, the inserted images and the album
+    version. A race lost to a concurrent upload of the same content is
+    saved again as a duplicate.
+    '''
+    for attempt in range(BATCH_UPLOAD_SAVE_ATTEMPTS):
+        stored = {}
+        duplicates = set()
+        for contentHash in hashes:
+            duplicate = Image.find_duplicate(contentHash, albumId)
+            if duplicate is not None:
+                stored[contentHash] = duplicate
+                duplicates.add(contentHash)
+            elif contentHash in uploaded:
+                stored[contentHash] = Image.fromUpload(
+                    uploaded[contentHash], albumId, contentHash)
+        newImages = [image for image in stored.values() if image.id is None]
+        if len(newImages) == 0:
+            # Releases the locks taken by Image.find_duplicate
+            db.session.rollback()
+            return stored, duplicates, newImages, None
+        try:
+            version = Album.bump_version(albumId)
+            Image.insert_all(newImages)
+            return stored, duplicates, newImages, version
+        except IntegrityError:
+            # The same file was uploaded concurrently to the album
+            db.session.rollback()
+    raise Exception(IMAGEKIT_EXCEPTION_MESSAGE)
+
+
+def save_duplicate(image):
+    '''
+    Returns the response of an upload whose content is already stored,
+    the image found by Image.find_duplicate is inserted when it was copied
+    from another album
+    '''
+    if image.id is None:
+        version = Album.bump_version(image.albumId)
+        image.insert()
+        response_cache.invalidate(album_cache_tag(image.albumId))
+        similarity_index.update(
+            image.albumId, version, added=[(image.id, image.perceptualHash)])
+    else:
+        # Releases the lock taken by Image.find_duplicate
+        db.session.rollback()
+    return {
+        "success": True,
+        "duplicate": True,
+        "images": [image.getData()],
+    }
+
+
 @app.route("/albums/<int:albumId>/images", methods=["POST"])
 @requires_auth('post:images')
 def upload_image(payload, albumId):
@@ -98,23 +598,45 @@ def upload_image(payload, albumId):
         album = Album.query.filter_by(id=albumId).first()
         if album is None:
             raise Exception(NO_ALBUM_FOUND_MESSAGE)
+        # Werkzeug spools big uploads to a temporary file while hashing
+        # them, which is preprocessed in another process and streamed to
+        # imagekit
+        file = request.files['file'].stream
+        contentHash = file.hexdigest()
+        duplicate = Image.find_duplicate(contentHash, albumId)
+        if duplicate is not None:
+            return jsonify(save_duplicate(duplicate))
+        if request.args.get('async', 'false').lower() == 'true':
+            job = enqueue_upload(request.files['file'], albumId, contentHash)
+            return jsonify({
+                    "success": True,
+                    "jobs": [job.getData()],
+                }), 202
         try:
-            image = request.files['file'].read()
-            response = ik.upload_image(image, "image.jpeg")
+            response = ik.upload_file(file, "image.jpeg")
         except Exception as e:
             print("\nIMAGEKIT_EXCEPTION upload_image", e, end='\n\n')
             raise Exception(IMAGEKIT_EXCEPTION_MESSAGE)
-        image = Image(
-            w=response['metadata']['width'],
-            h=response['metadata']['height'],
-            url=response['metadata']['url'],
-            imageKitId=response['metadata']['fileId'],
-            albumId=albumId
-        )
-        image.insert()
+        if not response['success']:
+            raise Exception(IMAGEKIT_EXCEPTION_MESSAGE)
+        image = Image.fromUpload(response, albumId, contentHash)
+        try:
+            version = Album.bump_version(albumId)
+            image.insert()
+        except IntegrityError:
+            # The same file was uploaded concurrently to the album
+            db.session.rollback()
+            delete_unreferenced_file(image.imageKitId)
+            duplicate = Image.find_duplicate(contentHash, albumId)
+            return jsonify(save_duplicate(duplicate))
+        response_cache.invalidate(album_cache_tag(albumId))
+        similarity_index.update(
+            albumId, version, added=[(image.id, image.perceptualHash)])
         response = {}
         response["success"] = True
         response["images"] = [image.getData()]
+        response["similar"] = [
+            imageId for imageId, _ in find_similar_images(image)]
         return jsonify(response)
     except Exception as e:
         print("\nEXCEPTION upload_image", e, end='\n\n')
@@ -124,6 +646,97 @@ def upload_image(payload, albumId):
             abort(422)
 
 
+@app.route("/albums/<int:albumId>/images/batch", methods=["POST"])
+@requires_auth('post:images')
+def upload_images(payload, albumId):
+    try:
+        files = request.files.getlist('files')
+        if len(files) == 0:
+            raise Exception(NO_FILE_IN_UPLOAD_REQUEST_MESSAGE)
+        if len(files) > MAX_BATCH_UPLOAD_FILES:
+            raise Exception(TOO_MANY_FILES_IN_UPLOAD_REQUEST_MESSAGE)
+        album = Album.query.filter_by(id=albumId).first()
+        if album is None:
+            raise Exception(NO_ALBUM_FOUND_MESSAGE)
+
+        # Every content is uploaded once, even if it is repeated in the
+        # batch, and never if it is already stored. The locks the lookup
+        # takes are released before the uploads.
+        hashes = [file.stream.hexdigest() for file in files]
+        contents = {}
+        for file, contentHash in zip(files, hashes):
+            contents.setdefault(contentHash, file)
+        uploads = {
+            contentHash: file for contentHash, file in contents.items()
+            if Image.find_duplicate(contentHash, albumId) is None
+        }
+        db.session.rollback()
+        responses = ik.upload_images(
+            [(file.stream, "image.jpeg") for file in uploads.values()])
+        responses = dict(zip(uploads.keys(), responses))
+        uploaded = {
+            contentHash: response
+            for contentHash, response in responses.items()
+            if response['success']
+        }
+
+        try:
+            stored, duplicates, newImages, version = save_batch(
+                albumId, list(contents), uploaded)
+        except Exception:
+            # Do not leave orphan files in imagekit
+            db.session.rollback()
+            for response in uploaded.values():
+                delete_unreferenced_file(response['metadata']['fileId'])
+            raise
+        # Files of the contents saved meanwhile by a concurrent upload
+        for contentHash, response in uploaded.items():
+            if contentHash in duplicates:
+                delete_unreferenced_file(response['metadata']['fileId'])
+        if len(newImages) > 0:
+            response_cache.invalidate(album_cache_tag(albumId))
+            similarity_index.update(albumId, version, added=[
+                (image.id, image.perceptualHash) for image in newImages])
+
+        results = []
+        reported = set()
+        for file, contentHash in zip(files, hashes):
+            result = {"file": file.filename}
+            if contentHash in stored:
+                result["success"] = True
+                result["image"] = stored[contentHash]
+                if contentHash in duplicates or contentHash in reported:
+                    result["duplicate"] = True
+                reported.add(contentHash)
+            else:
+                result["success"] = False
+                response = responses.get(contentHash)
+                result["message"] = DUPLICATE_DELETED_MESSAGE \
+                    if response is None else str(response.get('message'))
+            results.append(result)
+        if len(stored) == 0:
+            raise Exception(IMAGEKIT_EXCEPTION_MESSAGE)
+
+        for result in results:
+            if "image" in result:
+                result["image"] = result["image"].id
+        return jsonify({
+                "success": True,
+                "images": [image.getData() for image in stored.values()],
+                "results": results,
+            })
+    except Exception as e:
+        print("\nEXCEPTION upload_images", e, end='\n\n')
+        if e.__str__() in [
+                NO_FILE_IN_UPLOAD_REQUEST_MESSAGE,
+                TOO_MANY_FILES_IN_UPLOAD_REQUEST_MESSAGE]:
+            abort(400)
+        elif e.__str__() == NO_ALBUM_FOUND_MESSAGE:
+            abort(404)
+        else:
+            abort(422)
+
+
 @app.route("/albums", methods=["POST"])
 @requires_auth('post:albums')
 def create_album(payload):
@@ -137,6 +750,7 @@ def create_album(payload):
                 name=albumName
             )
             album.insert()
+            response_cache.invalidate(ALBUMS_CACHE_TAG)
             response = {}
             response["success"] = True
             response["albums"] = [album.getData()]
@@ -151,22 +765,167 @@ def create_album(payload):
             abort(422)
 
 
+def album_operations(data):
+    '''
+    Validates the operations of POST /albums/batch. An album can only be
+    renamed or deleted by one operation of the batch.
+    '''
+    if not isinstance(data, dict) or \
+            not isinstance(data.get('operations'), list) or \
+            len(data['operations']) == 0:
+        raise Exception(INVALID_BATCH_OPERATIONS_MESSAGE)
+    operations = data['operations']
+    if len(operations) > MAX_BATCH_ALBUM_OPERATIONS:
+        raise Exception(TOO_MANY_BATCH_OPERATIONS_MESSAGE)
+    albumIds = set()
+    for operation in operations:
+        if not isinstance(operation, dict) or \
+                operation.get('op') not in ALBUM_OPERATION_PERMISSIONS:
+            raise Exception(INVALID_BATCH_OPERATIONS_MESSAGE)
+        if operation['op'] == 'create':
+            albumName = operation.get('albumName')
+            if not isinstance(albumName, str) or len(albumName) == 0:
+                raise Exception(INVALID_BATCH_OPERATIONS_MESSAGE)
+            continue
+        albumId = operation.get('albumId')
+        if type(albumId) is not int or albumId in albumIds:
+            raise Exception(INVALID_BATCH_OPERATIONS_MESSAGE)
+        albumIds.add(albumId)
+        if operation['op'] == 'rename' and \
+                not isinstance(operation.get('newName'), str):
+            raise Exception(INVALID_BATCH_OPERATIONS_MESSAGE)
+    return operations
+
+
+@app.route("/albums/batch", methods=["POST"])
+@requires_auth(None)
+def batch_albums(payload):
+    '''
+    Creates, renames and deletes albums in a single transaction, with a
+    statement for every kind of operation
+    '''
+    try:
+        operations = album_operations(request.get_json(silent=True))
+    except Exception as e:
+        print("\nEXCEPTION batch_albums", e, end='\n\n')
+        abort(400)
+    check_permissions(frozenset(
+        ALBUM_OPERATION_PERMISSIONS[operation['op']]
+        for operation in operations
+    ), payload)
+    try:
+        names = [operation['albumName'] for operation in operations
+                 if operation['op'] == 'create']
+        newNames = {operation['albumId']: operation['newName']
+                    for operation in operations if operation['op'] == 'rename'}
+        albumIds = [operation['albumId'] for operation in operations
+                    if operation['op'] == 'delete']
+        created = iter(Album.insert_names(names) if names else [])
+        renamed = {row.id: row for row in
+                   (Album.rename_all(newNames) if newNames else [])}
+        deleted = set(Album.delete_all(albumIds) if albumIds else [])
+        db.session.commit()
+        # The imagekit files of the deleted albums are deleted in
+        # background by the worker
+        response_cache.invalidate(ALBUMS_CACHE_TAG, *[
+            album_cache_tag(albumId) for albumId in deleted])
+        for row in renamed.values():
+            similarity_index.update(row.id, row.version)
+        for albumId in deleted:
+            similarity_index.drop(albumId)
+
+        results = []
+        for operation in operations:
+            result = {"op": operation['op'], "success": True}
+            if operation['op'] == 'create':
+                result["album"] = next(created)
+            elif operation['op'] == 'rename' and \
+                    operation['albumId'] in renamed:
+                row = renamed[operation['albumId']]
+                result["album"] = {"id": row.id, "name": row.name}
+            elif operation['op'] == 'delete' and \
+                    operation['albumId'] in deleted:
+                result["delete"] = operation['albumId']
+            else:
+                result["success"] = False
+                result["albumId"] = operation['albumId']
+                result["error"] = 404
+                result["message"] = NO_ALBUM_FOUND_MESSAGE
+            results.append(result)
+        return jsonify({
+                "success": True,
+                "results": results,
+            })
+    except Exception as e:
+        print("\nEXCEPTION batch_albums", e, end='\n\n')
+        db.session.rollback()
+        abort(422)
+
+
+def include_images(albums):
+    '''
+    Adds to every album its first images_per_album images and the
+    next_cursor to get the rest from /albums/<id>/images, fetching the
+    images of all of them with a single query
+    '''
+    try:
+        limit = int(request.args.get(
+            'images_per_album', DEFAULT_IMAGES_PER_ALBUM))
+    except ValueError:
+        raise Exception(INVALID_INCLUDE_MESSAGE)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise Exception(INVALID_INCLUDE_MESSAGE)
+    srcset = request.args.get('srcset', 'false').lower() == 'true'
+    albumsById = {}
+    for album in albums:
+        album["images"] = []
+        album["next_cursor"] = None
+        albumsById[album["id"]] = album
+    # One more image per album tells whether there are more
+    rows = Image.first_per_album(list(albumsById), limit + 1)
+    for image in rows:
+        album = albumsById[image.albumId]
+        if len(album["images"]) == limit:
+            album["next_cursor"] = album["images"][-1]["id"]
+        else:
+            album["images"].append(image_data(image, srcset))
+
+
 @app.route("/albums")
+@conditional(albums_etag)
+@response_cache.cached(lambda: [ALBUMS_CACHE_TAG])
 def get_albums():
     try:
-        albums = [
-            album.getData() for
-            album in Album.query.order_by(asc(Album.id)).all()
-        ]
-        if len(albums) == 0:
+        after, limit = get_page_arguments()
+        include = request.args.get('include', None)
+        if include not in [None, 'images']:
+            raise Exception(INVALID_INCLUDE_MESSAGE)
+        statement = db.select(*Album.data_columns())
+        if limit is None and include is None:
+            return stream_listing(
+                statement,
+                Album.id,
+                after,
+                "albums",
+                Album.rowData,
+                NO_ALBUMS_TO_SHOW_MESSAGE
+            )
+        rows, next_cursor = paginate(statement, Album.id, after, limit)
+        albums = [Album.rowData(row) for row in rows]
+        if include == 'images':
+            include_images(albums)
+        if len(albums) == 0 and after is None:
             raise Exception(NO_ALBUMS_TO_SHOW_MESSAGE)
-        return jsonify({
+        return json_response({
                 "success": True,
                 "albums": albums,
+                "next_cursor": next_cursor,
             })
     except Exception as e:
         print("\nEXCEPTION get_albums", e, end='\n\n')
-        if e.__str__() == NO_ALBUMS_TO_SHOW_MESSAGE:
+        if e.__str__() in [
+                NO_ALBUMS_TO_SHOW_MESSAGE, INVALID_PAGINATION_MESSAGE,
+                INVALID_INCLUDE_MESSAGE]:
             abort(400)
         else:
             abort(422)
@@ -179,7 +938,10 @@ def delete_album(payload, albumId):
         album = Album.query.filter_by(id=albumId).first()
         if album is None:
             raise Exception(NO_ALBUM_FOUND_MESSAGE)
-        album.delete()
+        # The imagekit files are deleted in background by the worker
+        album.delete_cascade()
+        response_cache.invalidate(ALBUMS_CACHE_TAG, album_cache_tag(albumId))
+        similarity_index.drop(albumId)
         return jsonify({
                 "success": True,
                 "delete": albumId,
@@ -206,7 +968,10 @@ def patch_album(payload, albumId):
             if album is None:
                 raise Exception(NO_ALBUM_FOUND_MESSAGE)
             album.name = newName
+            album.version = Album.version + 1
             album.update()
+            response_cache.invalidate(ALBUMS_CACHE_TAG)
+            similarity_index.update(albumId, album.version)
             return jsonify({
                     "success": True,
                     "albums": [album.getData()]
@@ -224,6 +989,35 @@ def patch_album(payload, albumId):
             abort(422)
 
 
+@app.route("/cache/stats")
+def get_cache_stats():
+    return jsonify({
+            "success": True,
+            "response_cache": response_cache.stats(),
+            "token_cache": token_cache.stats(),
+            "jwks": jwks_store.stats(),
+            "url_cache": ik.url_cache.stats(),
+            "similarity_index": similarity_index.stats(),
+            "storage": ik.storage.stats(),
+        })
+
+
+@app.route("/media/<fileId>")
+def get_media(fileId):
+    '''
+    Files of the filesystem storage, other storages serve them themselves
+    '''
+    return ik.storage.send(fileId)
+
+
+@app.route("/metrics")
+def get_metrics():
+    return Response(
+        metrics.registry.render(),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
 @app.errorhandler(AuthError)
 def unauthorized(error):
     return jsonify(
@@ -269,3 +1063,25 @@ def not_found(error):
                 "error": 405,
                 "message": "method not allowed"
             }), 405
+
+
+@app.cli.command('worker')
+def worker_command():
+    '''
+    Processes the queued async uploads and imagekit deletions
+    '''
+    from worker import run_worker
+    run_worker()
+
+
+@app.cli.command('backfill')
+@click.option('--batch-size', type=int, default=None)
+@click.option('--workers', type=int, default=None)
+def backfill_command(batch_size, workers):
+    '''
+    Computes the placeholders of the images that have none
+    '''
+    from backfill import BACKFILL_BATCH_SIZE, BACKFILL_WORKERS, \
+        backfill_placeholders
+    backfill_placeholders(
+        batch_size or BACKFILL_BATCH_SIZE, workers or BACKFILL_WORKERS)
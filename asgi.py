@@ -0,0 +1,366 @@
+'''
+ASGI entry point, an alternative to `gunicorn app:app`:
+
+    uvicorn asgi:app --workers 4
+
+Uploading and deleting images spend nearly all their time waiting on
+imagekit, Auth0 and the database, so they are coroutines here: the
+queries go through an async engine (asyncpg or aiosqlite), and imagekit
+and the JWKS through httpx, so a process keeps hundreds of them in
+flight. The rest of the routes, and the async=true uploads, are served
+by the Flask app in a thread pool. Routes, JSON bodies and errors are
+the same in both modes.
+'''
+import asyncio
+import contextlib
+import functools
+import hashlib
+import os
+import time
+import httpx
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import delete, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from app import app as flask_app, ik, response_cache, similarity_index, \
+    album_cache_tag, NO_FILE_IN_UPLOAD_REQUEST_MESSAGE, \
+    NO_ALBUM_FOUND_MESSAGE, NO_IMAGE_FOUND_MESSAGE, \
+    IMAGEKIT_EXCEPTION_MESSAGE, SIMILAR_MAX_DISTANCE, SIMILAR_MAX_RESULTS
+from auth import AuthError, JWKS_FETCH_TIMEOUT, check_permissions, \
+    get_verified_payload_async, parse_auth_header
+from metrics import HTTP_REQUEST_SECONDS, HTTP_REQUEST_ERRORS
+from models import database_path, Album, Image, ImageKitDeletion
+from serialization import dumps
+
+# Connections of every process, the uploads only hold one while they
+# read or write rows, not while imagekit answers
+ASYNC_DB_POOL_SIZE = int(os.environ.get('ASYNC_DB_POOL_SIZE', 20))
+ASYNC_DB_MAX_OVERFLOW = int(os.environ.get('ASYNC_DB_MAX_OVERFLOW', 10))
+# Threads running the Flask app
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 16))
+HASH_CHUNK_SIZE = 1024 * 1024
+
+ERROR_MESSAGES = {
+    400: "bad request",
+    404: "resource not found",
+    422: "unprocessable",
+}
+
+
+def async_database_url(url):
+    '''
+    DATABASE_URL with the asyncpg or aiosqlite driver, asyncpg takes ssl
+    instead of the sslmode of libpq
+    '''
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend == 'sqlite':
+        return url.set(drivername='sqlite+aiosqlite')
+    query = dict(url.query)
+    if 'sslmode' in query:
+        query['ssl'] = query.pop('sslmode')
+    return url.set(drivername=backend + '+asyncpg', query=query)
+
+
+def create_engine():
+    url = async_database_url(database_path)
+    if url.get_backend_name() == 'sqlite':
+        return create_async_engine(url)
+    return create_async_engine(
+        url,
+        pool_size=ASYNC_DB_POOL_SIZE,
+        max_overflow=ASYNC_DB_MAX_OVERFLOW
+    )
+
+
+def json_response(data, status=200):
+    return Response(
+        dumps(data), status_code=status, media_type='application/json')
+
+
+def abort(status):
+    raise HTTPException(status)
+
+
+def content_hash(file):
+    '''
+    SHA-256 of the spooled upload, Flask computes it while spooling
+    '''
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+async def fetch_jwks(url):
+    response = await app.state.http.get(url)
+    response.raise_for_status()
+    return response.json()
+
+
+def requires_auth(permission=''):
+    def requires_auth_decorator(f):
+        @functools.wraps(f)
+        async def wrapper(request):
+            token = parse_auth_header(
+                request.headers.get('Authorization', None))
+            payload = await get_verified_payload_async(token, fetch_jwks)
+            check_permissions(permission, payload)
+            return await f(payload, request)
+
+        return wrapper
+    return requires_auth_decorator
+
+
+def handles_errors(rule):
+    '''
+    Answers the errors with the bodies of the Flask error handlers, adds
+    the CORS header flask_cors adds and times the request under the Flask
+    rule of the route
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapper(request):
+            start = time.perf_counter()
+            try:
+                response = await f(request)
+            except AuthError as error:
+                response = json_response({
+                        "success": False,
+                        "error": error.status_code,
+                        "message": error.error,
+                    }, error.status_code)
+            except HTTPException as error:
+                response = json_response({
+                        "success": False,
+                        "error": error.status_code,
+                        "message": ERROR_MESSAGES[error.status_code],
+                    }, error.status_code)
+            origin = request.headers.get('Origin')
+            if origin is not None:
+                response.headers['Access-Control-Allow-Origin'] = origin
+                response.headers['Vary'] = 'Origin'
+            labels = {"method": request.method, "route": rule}
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, **labels)
+            if response.status_code >= 400:
+                HTTP_REQUEST_ERRORS.inc(status=response.status_code, **labels)
+            return response
+
+        return wrapper
+    return decorator
+
+
+async def find_similar_images(session, image,
+                              maxDistance=SIMILAR_MAX_DISTANCE,
+                              limit=SIMILAR_MAX_RESULTS):
+    '''
+    (imageId, distance) of the near-duplicates of the image in its album
+    '''
+    if image.perceptualHash is None:
+        return []
+    version = await session.scalar(
+        select(Album.version).where(Album.id == image.albumId))
+    if version is None:
+        return []
+    index = similarity_index.peek(image.albumId, version)
+    if index is None:
+        rows = await Image.perceptual_hashes_async(session, image.albumId)
+        index = similarity_index.put(image.albumId, version, rows)
+    return index.search(
+        image.perceptualHash, maxDistance, limit, exclude=image.id)
+
+
+async def save_duplicate(session, image):
+    '''
+    save_duplicate of the Flask app for an AsyncSession
+    '''
+    if image.id is None:
+        version = await Album.bump_version_async(session, image.albumId)
+        session.add(image)
+        await session.commit()
+        response_cache.invalidate(album_cache_tag(image.albumId))
+        similarity_index.update(
+            image.albumId, version, added=[(image.id, image.perceptualHash)])
+        data = image.getData()
+    else:
+        data = image.getData()
+        # Releases the lock taken by Image.find_duplicate_async
+        await session.rollback()
+    return {
+        "success": True,
+        "duplicate": True,
+        "images": [data],
+    }
+
+
+async def save_upload(sessions, file, albumId):
+    '''
+    Every query runs in a short session, no connection is held while the
+    image is processed and uploaded
+    '''
+    contentHash = await asyncio.to_thread(content_hash, file)
+    async with sessions() as session:
+        album = await session.get(Album, albumId)
+        if album is None:
+            raise Exception(NO_ALBUM_FOUND_MESSAGE)
+        duplicate = await Image.find_duplicate_async(
+            session, contentHash, albumId)
+        if duplicate is not None:
+            return json_response(await save_duplicate(session, duplicate))
+    try:
+        response = await ik.upload_file_async(file, "image.jpeg")
+    except Exception as e:
+        print("\nIMAGEKIT_EXCEPTION upload_image", e, end='\n\n')
+        raise Exception(IMAGEKIT_EXCEPTION_MESSAGE)
+    if not response['success']:
+        raise Exception(IMAGEKIT_EXCEPTION_MESSAGE)
+    image = Image.fromUpload(response, albumId, contentHash)
+    async with sessions() as session:
+        try:
+            version = await Album.bump_version_async(session, albumId)
+            session.add(image)
+            await session.commit()
+        except IntegrityError:
+            # The same file was uploaded concurrently to the album
+            await session.rollback()
+            # The filesystem storage names the files by their content,
+            # the winner of the race may use the same one
+            references = await Image.count_references_async(
+                session, image.imageKitId)
+            await session.rollback()
+            if references == 0:
+                await ik.delete_image_async(image.imageKitId)
+            duplicate = await Image.find_duplicate_async(
+                session, contentHash, albumId)
+            return json_response(await save_duplicate(session, duplicate))
+        response_cache.invalidate(album_cache_tag(albumId))
+        similarity_index.update(
+            albumId, version, added=[(image.id, image.perceptualHash)])
+        similar = await find_similar_images(session, image)
+    return json_response({
+            "success": True,
+            "images": [image.getData()],
+            "similar": [imageId for imageId, _ in similar],
+        })
+
+
+@handles_errors('/albums/<int:albumId>/images')
+@requires_auth('post:images')
+async def upload_image(payload, request):
+    try:
+        async with request.form() as form:
+            file = form.get('file')
+            if not isinstance(file, UploadFile):
+                raise Exception(NO_FILE_IN_UPLOAD_REQUEST_MESSAGE)
+            return await save_upload(
+                request.app.state.sessions,
+                file.file,
+                request.path_params['albumId']
+            )
+    except Exception as e:
+        print("\nEXCEPTION upload_image", e, end='\n\n')
+        if e.__str__() == NO_FILE_IN_UPLOAD_REQUEST_MESSAGE:
+            abort(400)
+        else:
+            abort(422)
+
+
+@handles_errors('/images/<int:imageId>')
+@requires_auth('delete:images')
+async def delete_image(payload, request):
+    '''
+    The row is deleted and its file queued in a short session, no
+    connection or lock is held while imagekit deletes the file. A file
+    that could not be deleted is left to the worker.
+    '''
+    imageId = request.path_params['imageId']
+    sessions = request.app.state.sessions
+    try:
+        deletion = None
+        async with sessions() as session:
+            image = await session.get(Image, imageId)
+            if image is None:
+                raise Exception(NO_IMAGE_FOUND_MESSAGE)
+            imageKitId = image.imageKitId
+            albumId = image.albumId
+            # Images with the same content share the imagekit file, it is
+            # deleted with the last of them
+            if await Image.count_references_async(session, imageKitId) == 1:
+                deletion = ImageKitDeletion(imageKitId=imageKitId)
+                session.add(deletion)
+            version = await Album.bump_version_async(session, albumId)
+            await session.delete(image)
+            await session.commit()
+        response_cache.invalidate(album_cache_tag(albumId))
+        similarity_index.update(albumId, version, removed=[imageId])
+        if deletion is not None:
+            try:
+                response = await ik.delete_image_async(imageKitId)
+                if not response['success']:
+                    raise Exception(response['message'])
+                async with sessions() as session:
+                    await session.execute(delete(ImageKitDeletion).where(
+                        ImageKitDeletion.id == deletion.id))
+                    await session.commit()
+            except Exception as e:
+                print("\nIMAGEKIT_EXCEPTION delete_image", e, end='\n\n')
+        return json_response({
+                "success": True,
+                "delete": imageId,
+            })
+    except Exception as e:
+        print("\nEXCEPTION delete_image", e, end='\n\n')
+        if e.__str__() == NO_IMAGE_FOUND_MESSAGE:
+            abort(404)
+        else:
+            abort(422)
+
+
+class UploadImageEndpoint():
+    '''
+    The async=true uploads are spooled for the worker by the Flask app
+    '''
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        if request.query_params.get('async', 'false').lower() == 'true':
+            await wsgi(scope, receive, send)
+            return
+        response = await upload_image(request)
+        await response(scope, receive, send)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    engine = create_engine()
+    app.state.sessions = async_sessionmaker(engine, expire_on_commit=False)
+    app.state.http = httpx.AsyncClient(timeout=JWKS_FETCH_TIMEOUT)
+    await ik.storage.open_async()
+    try:
+        yield
+    finally:
+        await ik.storage.close_async()
+        await app.state.http.aclose()
+        await engine.dispose()
+
+
+wsgi = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+
+# The other methods of the paths, e.g. listing the images of an album
+# or the CORS preflights, fall through to the Flask app
+app = Starlette(
+    routes=[
+        Route('/albums/{albumId:int}/images', UploadImageEndpoint(),
+              methods=['POST']),
+        Route('/images/{imageId:int}', delete_image, methods=['DELETE']),
+        Mount('/', wsgi),
+    ],
+    lifespan=lifespan
+)
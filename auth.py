@@ -1,21 +1,50 @@
+import asyncio
+import hashlib
 import json
 import os
+import threading
+import time
 from flask import request
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
+from cache import LRUCache
+from metrics import registry
 
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', '')
 AUTH0_CLIENT_ID = os.environ.get('AUTH0_CLIENT_ID', '')
 ALGORITHMS = [os.environ.get('ALGORITHM', 'RS256')]
 AUTH0_AUDIENCE = os.environ.get('AUTH0_AUDIENCE', 'capstoneProject')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+# The benchmarks serve the signing keys locally
+AUTH0_JWKS_URL = os.environ.get(
+    'AUTH0_JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+JWKS_FETCH_SECONDS = registry.histogram(
+    'jwks_fetch_seconds', 'Duration of the JWKS fetches')
+JWKS_REFRESH_FAILURES = registry.counter(
+    'jwks_refresh_failures_total', 'JWKS refreshes that kept the old keys')
+JWT_VERIFICATION_SECONDS = registry.histogram(
+    'jwt_verification_seconds',
+    'Duration of the JWT verifications not served by the token cache')
+TOKEN_CACHE_REQUESTS = registry.counter(
+    'token_cache_requests_total', 'Token cache lookups by result')
 
 AUTH0_DOMAIN_MESSAGE = "Please set AUTH0_DOMAIN as environment variable"
 AUTH0_CLIENT_ID_MESSAGE = "Please set AUTH0_CLIENT_ID as environment variable"
 
-assert len(AUTH0_DOMAIN) > 0, AUTH0_DOMAIN_MESSAGE
-assert len(AUTH0_CLIENT_ID) > 0, AUTH0_CLIENT_ID_MESSAGE
+
+def check_settings():
+    '''
+    Checked on the first verification, so the app and the scripts that
+    import it start without them
+    '''
+    assert len(AUTH0_DOMAIN) > 0, AUTH0_DOMAIN_MESSAGE
+    assert len(AUTH0_CLIENT_ID) > 0, AUTH0_CLIENT_ID_MESSAGE
 
 
 # AuthError Exception
@@ -29,12 +58,149 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS key store
+class JWKSStore():
+    '''
+    Process-wide cache of the Auth0 signing keys.
+    Keys are parsed once and indexed by kid. The key set is fetched
+    again when it is older than ttl or when an unknown kid shows up,
+    but never more often than min_refresh_interval. If the fetch fails
+    the keys already known keep being served.
+    '''
+    def __init__(
+            self, url, ttl=JWKS_TTL,
+            min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL, fetch=None):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.fetch = fetch if fetch is not None else self.fetch_jwks
+        self.keys = {}
+        self.fetched_at = None
+        self.attempted_at = None
+        self.refresh_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        # Refresh in flight in the event loop of the ASGI app
+        self.refreshing = None
+
+    def fetch_jwks(self):
+        jsonurl = urlopen(self.url, timeout=JWKS_FETCH_TIMEOUT)
+        return json.loads(jsonurl.read())
+
+    def is_expired(self, now):
+        return self.fetched_at is None or now - self.fetched_at > self.ttl
+
+    def can_refresh(self, now):
+        return self.attempted_at is None or \
+            now - self.attempted_at >= self.min_refresh_interval
+
+    def load(self, jwks):
+        from jose import jwk
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+                continue
+            keys[key['kid']] = jwk.construct(key, ALGORITHMS[0])
+        self.keys = keys
+        self.fetched_at = time.monotonic()
+        self.refreshes += 1
+
+    def refresh(self):
+        try:
+            with JWKS_FETCH_SECONDS.time():
+                jwks = self.fetch()
+            self.load(jwks)
+        except Exception as e:
+            self.refresh_failures += 1
+            JWKS_REFRESH_FAILURES.inc()
+            print("\nEXCEPTION jwks refresh", e, end='\n\n')
+        finally:
+            # Set when the fetch ends, so a refresh in flight in the event
+            # loop does not stop the Flask threads from refreshing
+            self.attempted_at = time.monotonic()
+
+    async def refresh_async(self, fetch):
+        try:
+            with JWKS_FETCH_SECONDS.time():
+                jwks = await fetch(self.url)
+            self.load(jwks)
+        except Exception as e:
+            self.refresh_failures += 1
+            JWKS_REFRESH_FAILURES.inc()
+            print("\nEXCEPTION jwks refresh", e, end='\n\n')
+        finally:
+            self.attempted_at = time.monotonic()
+            self.refreshing = None
+
+    def prefetch(self):
+        '''
+        Fetches the keys before the first request. If it fails the first
+        request can still refresh them.
+        '''
+        self.refresh()
+        if self.fetched_at is None:
+            self.attempted_at = None
+
+    def get_key(self, kid):
+        key = self.keys.get(kid)
+        if key is not None and not self.is_expired(time.monotonic()):
+            self.hits += 1
+            return key
+        self.misses += 1
+        with self.refresh_lock:
+            # Another request may have refreshed the keys while we waited
+            now = time.monotonic()
+            key = self.keys.get(kid)
+            if key is not None and not self.is_expired(now):
+                return key
+            if self.can_refresh(now):
+                self.refresh()
+            return self.keys.get(kid)
+
+    async def get_key_async(self, kid, fetch):
+        '''
+        get_key for coroutines, fetch(url) returns the JWKS. The requests
+        that miss while the keys are fetched wait for the same fetch.
+        '''
+        key = self.keys.get(kid)
+        if key is not None and not self.is_expired(time.monotonic()):
+            self.hits += 1
+            return key
+        self.misses += 1
+        if self.refreshing is None and self.can_refresh(time.monotonic()):
+            self.refreshing = asyncio.ensure_future(self.refresh_async(fetch))
+        if self.refreshing is not None:
+            await asyncio.shield(self.refreshing)
+        return self.keys.get(kid)
+
+    def stats(self):
+        return {
+            "keys": len(self.keys),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+        }
+
+
+jwks_store = JWKSStore(AUTH0_JWKS_URL)
+
+# Payloads of already verified tokens, keyed by the token digest and
+# kept until the token expires
+token_cache = LRUCache(TOKEN_CACHE_SIZE)
+
+
 # Auth Header
 
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
     """
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(auth):
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -65,12 +231,19 @@ def get_token_auth_header():
 
 
 def check_permissions(permission, payload):
+    '''
+    permission can be a frozenset, all of its permissions are required
+    '''
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'bad_request ',
             'description': 'Payload does not contain permissions'
         }, 400)
-    if permission not in payload['permissions']:
+    if isinstance(permission, frozenset):
+        allowed = permission.issubset(payload['permissions'])
+    else:
+        allowed = permission in payload['permissions']
+    if not allowed:
         raise AuthError({
             'code': 'forbidden',
             'description': 'User does not have the right permissions'
@@ -78,27 +251,30 @@ def check_permissions(permission, payload):
     return True
 
 
-def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+def get_key_id(token):
+    from jose import jwt
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = None
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
+    return unverified_header['kid']
+
+
+def verify_decode_jwt(token):
+    check_settings()
+    return decode_jwt(token, jwks_store.get_key(get_key_id(token)))
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
 
+async def verify_decode_jwt_async(token, fetch):
+    check_settings()
+    return decode_jwt(
+        token, await jwks_store.get_key_async(get_key_id(token), fetch))
+
+
+def decode_jwt(token, rsa_key):
+    from jose import jwt
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -133,13 +309,68 @@ def verify_decode_jwt(token):
             }, 400)
 
 
+def get_verified_payload(token):
+    """Returns the payload of the token, verifying it only if it is not
+    in the token cache. The permissions are stored as a frozenset.
+    """
+    digest = hashlib.sha256(token.encode()).digest()
+    payload = get_cached_payload(digest)
+    if payload is None:
+        start = time.perf_counter()
+        try:
+            payload = verify_decode_jwt(token)
+        except AuthError:
+            JWT_VERIFICATION_SECONDS.observe(
+                time.perf_counter() - start, result='error')
+            raise
+        payload = cache_payload(digest, payload, start)
+    return payload
+
+
+async def get_verified_payload_async(token, fetch):
+    """get_verified_payload for coroutines, fetch(url) returns the JWKS
+    """
+    digest = hashlib.sha256(token.encode()).digest()
+    payload = get_cached_payload(digest)
+    if payload is None:
+        start = time.perf_counter()
+        try:
+            payload = await verify_decode_jwt_async(token, fetch)
+        except AuthError:
+            JWT_VERIFICATION_SECONDS.observe(
+                time.perf_counter() - start, result='error')
+            raise
+        payload = cache_payload(digest, payload, start)
+    return payload
+
+
+def get_cached_payload(digest):
+    payload = token_cache.get(digest)
+    TOKEN_CACHE_REQUESTS.inc(result='miss' if payload is None else 'hit')
+    return payload
+
+
+def cache_payload(digest, payload, start):
+    JWT_VERIFICATION_SECONDS.observe(time.perf_counter() - start, result='ok')
+    if 'permissions' in payload:
+        payload['permissions'] = frozenset(payload['permissions'])
+    if 'exp' in payload:
+        token_cache.set(digest, payload, payload['exp'])
+    return payload
+
+
 def requires_auth(permission=''):
+    '''
+    With permission None the route checks the permissions, for the routes
+    whose permissions depend on the request
+    '''
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload = get_verified_payload(token)
+            if permission is not None:
+                check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
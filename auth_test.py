@@ -0,0 +1,159 @@
+import asyncio
+import time
+import unittest
+import rsa
+from jose import jwk, jwt
+import auth
+from auth import JWKSStore, check_permissions, get_verified_payload
+
+
+def create_jwk(kid):
+    _, private_key = rsa.newkeys(512)
+    key = jwk.construct(private_key.save_pkcs1().decode(), 'RS256')
+    data = key.public_key().to_dict()
+    data['kid'] = kid
+    data['use'] = 'sig'
+    return data
+
+
+class JWKSStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.jwks = {'keys': [create_jwk('first')]}
+        self.fetches = 0
+        self.failing = False
+
+    def fetch(self):
+        self.fetches += 1
+        if self.failing:
+            raise Exception('Auth0 is down')
+        return self.jwks
+
+    def testKeysAreFetchedOnce(self):
+        store = JWKSStore('jwks', ttl=3600, min_refresh_interval=0,
+                          fetch=self.fetch)
+        self.assertTrue(store.get_key('first'))
+        self.assertTrue(store.get_key('first'))
+        self.assertTrue(store.get_key('first'))
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(store.stats()['hits'], 2)
+        self.assertEqual(store.stats()['misses'], 1)
+        self.assertEqual(store.stats()['refreshes'], 1)
+
+    def testUnknownKidRefreshIsRateLimited(self):
+        store = JWKSStore('jwks', ttl=3600, min_refresh_interval=3600,
+                          fetch=self.fetch)
+        self.assertTrue(store.get_key('first'))
+        self.assertIsNone(store.get_key('unknown'))
+        self.assertIsNone(store.get_key('unknown'))
+        self.assertEqual(self.fetches, 1)
+
+    def testUnknownKidTriggersRefresh(self):
+        store = JWKSStore('jwks', ttl=3600, min_refresh_interval=0,
+                          fetch=self.fetch)
+        self.assertTrue(store.get_key('first'))
+        self.jwks = {'keys': [create_jwk('second')]}
+        self.assertTrue(store.get_key('second'))
+        self.assertEqual(self.fetches, 2)
+
+    def testStaleKeysAreServedWhenRefreshFails(self):
+        store = JWKSStore('jwks', ttl=0, min_refresh_interval=0,
+                          fetch=self.fetch)
+        self.assertTrue(store.get_key('first'))
+        self.failing = True
+        self.assertTrue(store.get_key('first'))
+        self.assertEqual(store.stats()['refresh_failures'], 1)
+
+    def testFailedPrefetchDoesNotDelayTheFirstRefresh(self):
+        store = JWKSStore('jwks', ttl=3600, min_refresh_interval=3600,
+                          fetch=self.fetch)
+        self.failing = True
+        store.prefetch()
+        self.failing = False
+        self.assertTrue(store.get_key('first'))
+        self.assertEqual(self.fetches, 2)
+
+    def testConcurrentAsyncMissesShareTheFetch(self):
+        store = JWKSStore('jwks', ttl=3600, min_refresh_interval=0)
+
+        async def fetch(url):
+            self.fetches += 1
+            await asyncio.sleep(0.01)
+            return self.jwks
+
+        async def get_keys():
+            return await asyncio.gather(*[
+                store.get_key_async('first', fetch) for _ in range(10)])
+
+        self.assertTrue(all(asyncio.run(get_keys())))
+        self.assertEqual(self.fetches, 1)
+
+    def testAsyncRefreshInFlightDoesNotBlockSyncRefresh(self):
+        store = JWKSStore('jwks', ttl=3600, min_refresh_interval=3600,
+                          fetch=self.fetch)
+
+        async def fetch(url):
+            # A Flask thread misses while the event loop is fetching
+            self.assertTrue(store.get_key('first'))
+            return self.jwks
+
+        self.assertTrue(asyncio.run(store.get_key_async('first', fetch)))
+        self.assertEqual(self.fetches, 1)
+
+
+class TokenCacheTests(unittest.TestCase):
+    def setUp(self):
+        _, private_key = rsa.newkeys(512)
+        self.private_key = private_key.save_pkcs1().decode()
+        public_key = jwk.construct(self.private_key, 'RS256').public_key()
+        key = public_key.to_dict()
+        key['kid'] = 'test'
+        self.verifications = 0
+
+        def fetch():
+            self.verifications += 1
+            return {'keys': [key]}
+
+        self.jwks_store = auth.jwks_store
+        auth.jwks_store = JWKSStore('jwks', ttl=0, min_refresh_interval=0,
+                                    fetch=fetch)
+        auth.token_cache.clear()
+
+    def tearDown(self):
+        auth.jwks_store = self.jwks_store
+        auth.token_cache.clear()
+
+    def createToken(self, expiresIn):
+        return jwt.encode({
+            'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+            'aud': auth.AUTH0_AUDIENCE,
+            'exp': int(time.time()) + expiresIn,
+            'permissions': ['post:images'],
+        }, self.private_key, algorithm='RS256', headers={'kid': 'test'})
+
+    def testTokenIsVerifiedOnce(self):
+        token = self.createToken(60)
+        payload = get_verified_payload(token)
+        self.assertEqual(payload['permissions'], frozenset(['post:images']))
+        self.assertIs(get_verified_payload(token), payload)
+        self.assertEqual(self.verifications, 1)
+
+    def testExpiredTokenIsNotServedFromCache(self):
+        token = self.createToken(1)
+        get_verified_payload(token)
+        time.sleep(2.5)
+        with self.assertRaises(auth.AuthError):
+            get_verified_payload(token)
+
+
+class PermissionsTests(unittest.TestCase):
+    def testEveryPermissionOfASetIsRequired(self):
+        payload = {'permissions': frozenset(['post:albums', 'patch:albums'])}
+        self.assertTrue(check_permissions(
+            frozenset(['post:albums', 'patch:albums']), payload))
+        with self.assertRaises(auth.AuthError):
+            check_permissions(
+                frozenset(['post:albums', 'delete:albums']), payload)
+
+
+if __name__ == "__main__":
+    unittest.main()
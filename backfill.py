@@ -0,0 +1,94 @@
+'''
+Computes the placeholders of the images uploaded before they existed:
+
+    python backfill.py --batch-size 200 --workers 8
+
+Images are read in batches ordered by id. The thumbnails of a batch are
+downloaded from imagekit concurrently, resized by imagekit so only a few
+KB are transferred, and the batch is saved with a single bulk update.
+It can be stopped and run again, it resumes from the rows still missing
+a placeholder.
+'''
+import argparse
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from app import app, ik
+from image_control import PLACEHOLDER_SIZE, placeholder_image
+from models import db, Album, Image
+
+BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', 200))
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', 8))
+BACKFILL_FETCH_TIMEOUT = float(os.environ.get('BACKFILL_FETCH_TIMEOUT', 10))
+# Size of the thumbnail downloaded to compute the placeholder
+BACKFILL_THUMBNAIL_SIZE = 4 * PLACEHOLDER_SIZE
+
+
+def fetch_placeholder(url):
+    '''
+    Returns the placeholder of the image in url, None if it fails
+    '''
+    try:
+        response = requests.get(
+            ik.thumbnail_url(url, BACKFILL_THUMBNAIL_SIZE),
+            timeout=BACKFILL_FETCH_TIMEOUT
+        )
+        response.raise_for_status()
+        return placeholder_image(io.BytesIO(response.content),
+                                 PLACEHOLDER_SIZE)
+    except Exception as e:
+        print("\nEXCEPTION fetch_placeholder", url, e, end='\n\n')
+        return None
+
+
+def backfill_placeholders(batch_size=BACKFILL_BATCH_SIZE,
+                          workers=BACKFILL_WORKERS):
+    '''
+    Returns how many placeholders were saved and how many failed. The
+    albums of every batch get a new version, so their cached listings
+    and ETags are renewed.
+    '''
+    after = 0
+    saved = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            rows = db.session.execute(
+                db.select(Image.id, Image.url, Image.albumId).where(
+                    Image.placeholder.is_(None),
+                    Image.id > after
+                ).order_by(Image.id).limit(batch_size)
+            ).all()
+            if len(rows) == 0:
+                break
+            after = rows[-1].id
+            placeholders = executor.map(
+                fetch_placeholder, [row.url for row in rows])
+            updates = [
+                {"id": row.id, "placeholder": placeholder}
+                for row, placeholder in zip(rows, placeholders)
+                if placeholder is not None
+            ]
+            if len(updates) > 0:
+                db.session.execute(db.update(Image), updates)
+                db.session.execute(
+                    db.update(Album)
+                    .where(Album.id.in_({row.albumId for row in rows}))
+                    .values(version=Album.version + 1)
+                )
+            db.session.commit()
+            saved += len(updates)
+            failed += len(rows) - len(updates)
+            print("Backfilled up to image {0}: {1} saved, {2} failed".format(
+                after, saved, failed))
+    return saved, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS)
+    args = parser.parse_args()
+    with app.app_context():
+        backfill_placeholders(args.batch_size, args.workers)
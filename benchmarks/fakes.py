@@ -0,0 +1,191 @@
+'''
+Local stand-ins of Auth0 and ImageKit, so the benchmarks run without
+accounts nor network. Both are HTTP servers running in daemon threads:
+
+* FakeAuth0 serves the JWKS of an RSA key generated at startup and mints
+  RS256 tokens signed with it, with the claims the app verifies.
+* FakeImageKit accepts uploads and single and bulk deletes, answering
+  after latency seconds and failing with probability failure_rate.
+
+The app is pointed to them with AUTH0_JWKS_URL, IMAGEKIT_API_BASE_URL and
+IMAGEKIT_UPLOAD_BASE_URL, see environment().
+'''
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import rsa
+from jose import jwt
+
+ALL_PERMISSIONS = [
+    'post:albums', 'patch:albums', 'delete:albums',
+    'post:images', 'delete:images',
+]
+
+
+def b64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, data=None):
+        body = b'' if data is None else json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer():
+    def __init__(self, handler):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.server.stand_in = self
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JWKSHandler(StandInHandler):
+    def do_GET(self):
+        if self.path != '/.well-known/jwks.json':
+            return self.send_json(404, {"message": "Not found"})
+        self.send_json(200, self.server.stand_in.jwks())
+
+
+class FakeAuth0(StandInServer):
+    def __init__(self, domain, audience):
+        super().__init__(JWKSHandler)
+        self.domain = domain
+        self.audience = audience
+        self.kid = uuid.uuid4().hex
+        self.public_key, private_key = rsa.newkeys(2048)
+        self.private_key = private_key.save_pkcs1().decode()
+
+    def jwks(self):
+        return {"keys": [{
+            "kty": "RSA",
+            "use": "sig",
+            "alg": "RS256",
+            "kid": self.kid,
+            "n": b64url_uint(self.public_key.n),
+            "e": b64url_uint(self.public_key.e),
+        }]}
+
+    def token(self, permissions=ALL_PERMISSIONS, ttl=3600, subject=None):
+        now = int(time.time())
+        claims = {
+            "iss": 'https://' + self.domain + '/',
+            "sub": subject or 'benchmark|' + uuid.uuid4().hex,
+            "aud": self.audience,
+            "iat": now,
+            "exp": now + ttl,
+            "permissions": list(permissions),
+        }
+        return jwt.encode(claims, self.private_key, algorithm='RS256',
+                          headers={"kid": self.kid})
+
+
+class ImageKitHandler(StandInHandler):
+    def do_POST(self):
+        stand_in = self.server.stand_in
+        body = self.read_body()
+        if not stand_in.respond():
+            return self.send_json(500, {"message": "Injected failure"})
+        if self.path == '/api/v1/files/upload':
+            fileId = uuid.uuid4().hex
+            stand_in.count('uploads')
+            return self.send_json(200, {
+                "fileId": fileId,
+                "name": fileId + '.jpeg',
+                "filePath": '/' + fileId + '.jpeg',
+                "url": stand_in.url_endpoint + '/' + fileId + '.jpeg',
+                "fileType": "image",
+                "size": len(body),
+                "width": 1600,
+                "height": 1200,
+            })
+        if self.path == '/v1/files/batch/deleteByFileIds':
+            fileIds = json.loads(body)["fileIds"]
+            stand_in.count('deletes', len(fileIds))
+            return self.send_json(200, {"successfullyDeletedFileIds": fileIds})
+        self.send_json(404, {"message": "Not found"})
+
+    def do_DELETE(self):
+        stand_in = self.server.stand_in
+        if not stand_in.respond():
+            return self.send_json(500, {"message": "Injected failure"})
+        if not self.path.startswith('/v1/files/'):
+            return self.send_json(404, {"message": "Not found"})
+        stand_in.count('deletes')
+        self.send_json(204)
+
+
+class FakeImageKit(StandInServer):
+    def __init__(self, url_endpoint, latency=0.0, failure_rate=0.0,
+                 seed=None):
+        super().__init__(ImageKitHandler)
+        self.url_endpoint = url_endpoint
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {"uploads": 0, "deletes": 0, "failures": 0}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def respond(self):
+        '''
+        Waits latency seconds, returns False when the request must fail
+        '''
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            failed = self.random.random() < self.failure_rate
+        if failed:
+            self.count('failures')
+        return not failed
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+def environment(auth0, imagekit):
+    '''
+    Environment variables that point the app to the stand-ins
+    '''
+    return {
+        "AUTH0_DOMAIN": auth0.domain,
+        "AUTH0_CLIENT_ID": 'benchmark',
+        "AUTH0_AUDIENCE": auth0.audience,
+        "AUTH0_JWKS_URL": auth0.url + '/.well-known/jwks.json',
+        "IMAGEKIT_PRIVATE_KEY": 'private_benchmark',
+        "IMAGEKIT_PUBLIC_KEY": 'public_benchmark',
+        "IMAGEKIT_URL_ENDPOINT": imagekit.url_endpoint,
+        "IMAGEKIT_API_BASE_URL": imagekit.url,
+        "IMAGEKIT_UPLOAD_BASE_URL": imagekit.url,
+    }
@@ -0,0 +1,110 @@
+'''
+Measures GET /albums/<id>/images before and after the (albumId, id)
+index of migration 23ce20a21843.
+
+It seeds N albums x M images, runs the requests without the index,
+creates it and runs them again. The response cache is cleared before
+every request, creating the index does not change the album versions
+and the second run would only measure the cache:
+
+    source .env_var
+    python -m benchmarks.get_images --albums 100 --images 1000
+
+WARNING: The database in DATABASE_URL is cleaned
+'''
+import argparse
+import random
+import time
+from sqlalchemy import insert, text
+from app import app, response_cache
+from models import db, db_drop_and_create_all, Album, Image
+from benchmarks.stats import summarize
+
+SEED_CHUNK_SIZE = 10000
+
+
+def seed(albums, images):
+    db_drop_and_create_all()
+    db.session.execute(
+        insert(Album),
+        [{"name": "Album {0}".format(i)} for i in range(albums)]
+    )
+    albumIds = [album.id for album in Album.query.all()]
+    rows = []
+    for i in range(images):
+        # Interleave albums so each album is spread over the whole table
+        for albumId in albumIds:
+            rows.append({
+                "w": 1600,
+                "h": 1200,
+                "url": "https://ik.imagekit.io/benchmark/{0}.jpeg".format(i),
+                "imageKitId": "benchmark_{0}_{1}".format(albumId, i),
+                "albumId": albumId,
+            })
+            if len(rows) == SEED_CHUNK_SIZE:
+                db.session.execute(insert(Image), rows)
+                rows = []
+    if rows:
+        db.session.execute(insert(Image), rows)
+    db.session.commit()
+    return albumIds
+
+
+def analyze():
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT")
+            connection.execute(text("ANALYZE images"))
+
+
+def measure(client, albumIds, requests, query):
+    timings = []
+    for _ in range(requests):
+        albumId = random.choice(albumIds)
+        response_cache.clear()
+        start = time.perf_counter()
+        res = client.get('/albums/{0}/images{1}'.format(albumId, query))
+        # all=true streams the rows, they are fetched while it is read
+        res.get_data()
+        timings.append(time.perf_counter() - start)
+        res.close()
+        assert res.status_code == 200, res.status_code
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--albums', type=int, default=100)
+    parser.add_argument('--images', type=int, default=1000,
+                        help='images per album')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--query', default='',
+                        help='query string, e.g. "?all=true"')
+    args = parser.parse_args()
+
+    client = app.test_client()
+    with app.app_context():
+        print("Seeding {0} albums x {1} images".format(
+            args.albums, args.images))
+        albumIds = seed(args.albums, args.images)
+        index = [
+            index for index in Image.__table__.indexes
+            if index.name == 'ix_images_albumId_id'
+        ][0]
+
+        index.drop(bind=db.engine, checkfirst=True)
+        analyze()
+        client.get('/albums/{0}/images'.format(albumIds[0]))
+        before = measure(client, albumIds, args.requests, args.query)
+
+        index.create(bind=db.engine, checkfirst=True)
+        analyze()
+        client.get('/albums/{0}/images'.format(albumIds[0]))
+        after = measure(client, albumIds, args.requests, args.query)
+
+    summarize("get_images without index", before)
+    summarize("get_images with index", after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+'''
+Measures the cold start of a worker: the time `import app` takes in a
+fresh interpreter, and the packages that take most of it according to
+`python -X importtime`:
+
+    source .env_var
+    python -m benchmarks.import_time --runs 10 --threshold-ms 1000
+
+Exits with an error when the median import time is over the threshold,
+or when importing the app loads a package that is only loaded on first
+use (numpy, the imagekit SDK, Flask-Migrate...). The threshold depends
+on the machine, the deferred packages do not.
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+# Loaded when the routes, the flask command line or warm_up need them
+DEFERRED_PACKAGES = (
+    'alembic', 'cv2', 'flask_migrate', 'httpx', 'imagekitio', 'jose',
+    'numpy', 'PIL', 'requests', 'requests_toolbelt',
+)
+
+
+def parse_importtime(output):
+    '''
+    (package, self, cumulative) in microseconds of every line of the
+    -X importtime report, nested imports are indented
+    '''
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def measure(module):
+    env = dict(os.environ, FLASK_RUN_FROM_CLI='false')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        text=True, check=True)
+    return parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--threshold-ms', type=float, default=1000)
+    args = parser.parse_args()
+
+    totals = []
+    packages = defaultdict(list)
+    loaded = set()
+    for _ in range(args.runs):
+        rows = measure(args.module)
+        totals.append(sum(self_us for _, self_us, _ in rows) / 1000)
+        cumulative = defaultdict(int)
+        for name, self_us, _ in rows:
+            cumulative[name.split('.')[0]] += self_us
+            loaded.add(name.split('.')[0])
+        for package, total_us in cumulative.items():
+            packages[package].append(total_us / 1000)
+
+    median = statistics.median(totals)
+    print("import {0}: median {1:.1f}ms, min {2:.1f}ms over {3} runs"
+          .format(args.module, median, min(totals), args.runs))
+    print("\nPackages by median import time:")
+    ranking = sorted(
+        ((statistics.median(times), package)
+         for package, times in packages.items()), reverse=True)
+    for time_ms, package in ranking[:args.top]:
+        print("  {0:<30} {1:8.1f}ms".format(package, time_ms))
+
+    failures = []
+    if median > args.threshold_ms:
+        failures.append("median {0:.1f}ms is over {1:.1f}ms".format(
+            median, args.threshold_ms))
+    deferred = sorted(loaded.intersection(DEFERRED_PACKAGES))
+    if deferred:
+        failures.append("imports packages loaded on first use: " +
+                        ", ".join(deferred))
+    if failures:
+        print("\nREGRESSION: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
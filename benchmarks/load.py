@@ -0,0 +1,325 @@
+'''
+Runs workload scenarios against `gunicorn app:app` (or `uvicorn asgi:app`
+with --server uvicorn) with the local Auth0 and ImageKit stand-ins of
+benchmarks.fakes, and reports the throughput and p50/p95/p99 of every
+route:
+
+    source .env_var
+    python -m benchmarks.load --scenario browse --duration 30
+    python -m benchmarks.load --scenario upload --imagekit-latency 0.2
+    python -m benchmarks.load --scenario upload --imagekit-latency 0.2 \
+        --server uvicorn --workers 1 --concurrency 200
+    python -m benchmarks.load --scenario churn --imagekit-failure-rate 0.05
+
+Scenarios:
+
+* browse: album listings, paginated and full image listings and
+  near-duplicate searches over the seeded albums.
+* upload: single and batch uploads of distinct images to the seeded
+  albums.
+* churn: every client creates an album, uploads a few images, renames
+  it, lists it and deletes it.
+
+Only DATABASE_URL is read from the environment, the app is started with
+the variables of the stand-ins. The deletions queued by churn are left
+for the worker.
+
+WARNING: The database in DATABASE_URL is cleaned
+'''
+import argparse
+import io
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import requests
+from benchmarks.fakes import FakeAuth0, FakeImageKit, environment
+from benchmarks.stats import summarize
+
+AUTH0_DOMAIN = 'benchmark.local'
+AUTH0_AUDIENCE = 'capstoneProject'
+IMAGEKIT_URL_ENDPOINT = 'https://ik.imagekit.io/benchmark'
+SEED_CHUNK_SIZE = 10000
+
+
+def sample_image(size=640):
+    '''
+    Returns a noisy JPEG, noise is not compressed so it weighs like a photo
+    '''
+    from PIL import Image as PILImage
+    data = os.urandom(size * size * 3)
+    image = PILImage.frombytes('RGB', (size, size), data)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+def distinct(image):
+    '''
+    Bytes after the end of the JPEG are ignored by decoders, so the copy
+    has another content hash and the same pixels
+    '''
+    return image + os.urandom(16)
+
+
+def seed(albums, images):
+    '''
+    Returns the ids of the seeded albums and a sample of their image ids
+    '''
+    import numpy as np
+    from sqlalchemy import insert
+    from app import app
+    from models import db, db_drop_and_create_all, Album, Image
+    rng = np.random.default_rng(0)
+    catalog = []
+    with app.app_context():
+        db_drop_and_create_all()
+        for n in range(albums):
+            album = Album(name="Album {0}".format(n))
+            album.insert()
+            rows = [{
+                "w": 1600,
+                "h": 1200,
+                "url": IMAGEKIT_URL_ENDPOINT + "/{0}_{1}.jpeg".format(n, i),
+                "imageKitId": "seed_{0}_{1}".format(n, i),
+                "albumId": album.id,
+                "perceptualHash": int(hash_),
+                "placeholder": "data:image/webp;base64," + "A" * 200,
+            } for i, hash_ in enumerate(rng.integers(
+                -2 ** 63, 2 ** 63 - 1, images, dtype=np.int64))]
+            for start in range(0, images, SEED_CHUNK_SIZE):
+                db.session.execute(
+                    insert(Image), rows[start:start + SEED_CHUNK_SIZE])
+            db.session.commit()
+            imageIds = db.session.execute(
+                db.select(Image.id).where(Image.albumId == album.id)
+                .limit(100)
+            ).scalars().all()
+            catalog.append((album.id, imageIds))
+    return catalog
+
+
+class Client():
+    '''
+    A user sending requests one after the other, the latency of every
+    request is recorded under its route
+    '''
+    def __init__(self, url, token, results):
+        self.url = url
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer ' + token
+        self.results = results
+
+    def request(self, method, route, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.url + path, timeout=60, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response = None
+            status = None
+        self.results.record(
+            method + ' ' + route, time.perf_counter() - start, status)
+        return response
+
+
+class Results():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.errors = {}
+
+    def record(self, route, duration, status):
+        with self.lock:
+            self.timings.setdefault(route, []).append(duration)
+            if status is None or status >= 400:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, elapsed):
+        total = sum(len(timings) for timings in self.timings.values())
+        print("{0} requests in {1:.1f}s, {2:.1f} requests/s".format(
+            total, elapsed, total / elapsed))
+        for route, timings in sorted(self.timings.items()):
+            summarize(route, timings)
+            print("{0:<40} {1:.1f} requests/s, {2} errors".format(
+                '', len(timings) / elapsed, self.errors.get(route, 0)))
+
+
+def browse(client, catalog, image, rng):
+    albumId, imageIds = rng.choice(catalog)
+    choice = rng.random()
+    if choice < 0.25:
+        client.request('GET', '/albums', '/albums')
+    elif choice < 0.45:
+        client.request(
+            'GET', '/albums?include=images',
+            '/albums?include=images&images_per_album=20&srcset=true')
+    elif choice < 0.8:
+        client.request(
+            'GET', '/albums/<albumId>/images',
+            '/albums/{0}/images?limit=50&srcset=true'.format(albumId))
+    elif choice < 0.85:
+        client.request(
+            'GET', '/albums/<albumId>/images?all=true',
+            '/albums/{0}/images?all=true'.format(albumId))
+    elif len(imageIds) > 0:
+        client.request(
+            'GET', '/albums/<albumId>/images/similar',
+            '/albums/{0}/images/similar?imageId={1}'.format(
+                albumId, rng.choice(imageIds)))
+
+
+def upload(client, catalog, image, rng):
+    albumId, _ = rng.choice(catalog)
+    if rng.random() < 0.7:
+        client.request(
+            'POST', '/albums/<albumId>/images',
+            '/albums/{0}/images'.format(albumId),
+            files={"file": ("image.jpeg", distinct(image))})
+    else:
+        client.request(
+            'POST', '/albums/<albumId>/images/batch',
+            '/albums/{0}/images/batch'.format(albumId),
+            files=[("files", ("image.jpeg", distinct(image)))
+                   for _ in range(5)])
+
+
+def churn(client, catalog, image, rng):
+    response = client.request(
+        'POST', '/albums', '/albums',
+        json={"albumName": "Churn {0}".format(rng.random())})
+    if response is None or response.status_code != 200:
+        return
+    albumId = response.json()["albums"][0]["id"]
+    for _ in range(3):
+        client.request(
+            'POST', '/albums/<albumId>/images',
+            '/albums/{0}/images'.format(albumId),
+            files={"file": ("image.jpeg", distinct(image))})
+    client.request(
+        'PATCH', '/albums/<albumId>', '/albums/{0}'.format(albumId),
+        json={"newName": "Renamed {0}".format(albumId)})
+    client.request(
+        'GET', '/albums/<albumId>/images',
+        '/albums/{0}/images'.format(albumId))
+    client.request(
+        'DELETE', '/albums/<albumId>', '/albums/{0}'.format(albumId))
+
+
+SCENARIOS = {
+    "browse": browse,
+    "upload": upload,
+    "churn": churn,
+}
+
+
+def run(scenario, url, tokens, catalog, duration, concurrency):
+    results = Results()
+    image = sample_image()
+    deadline = time.monotonic() + duration
+
+    def user(n):
+        client = Client(url, tokens[n % len(tokens)], results)
+        rng = random.Random(n)
+        while time.monotonic() < deadline:
+            scenario(client, catalog, image, rng)
+
+    threads = [threading.Thread(target=user, args=(n,))
+               for n in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.report(time.perf_counter() - start)
+
+
+def wait_until_ready(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception("The server exited with {0}".format(
+                process.returncode))
+        try:
+            requests.get(url + '/albums', timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise Exception("The server did not start in {0}s".format(timeout))
+
+
+def server_command(args):
+    bind = ['127.0.0.1', str(args.port)]
+    if args.server == 'uvicorn':
+        return [
+            sys.executable, '-m', 'uvicorn', 'asgi:app',
+            '--host', bind[0],
+            '--port', bind[1],
+            '--workers', str(args.workers),
+            '--log-level', 'warning',
+        ]
+    return [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '--bind', ':'.join(bind),
+        '--workers', str(args.workers),
+        '--threads', str(args.threads),
+        '--log-level', 'warning',
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', choices=SCENARIOS.keys(),
+                        default='browse')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--server', choices=['gunicorn', 'uvicorn'],
+                        default='gunicorn')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4,
+                        help='threads of every gunicorn worker')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--albums', type=int, default=20)
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=8,
+                        help='distinct tokens, verified once per worker')
+    parser.add_argument('--imagekit-latency', type=float, default=0.05)
+    parser.add_argument('--imagekit-failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    auth0 = FakeAuth0(AUTH0_DOMAIN, AUTH0_AUDIENCE).start()
+    imagekit = FakeImageKit(
+        IMAGEKIT_URL_ENDPOINT, args.imagekit_latency,
+        args.imagekit_failure_rate, seed=0).start()
+    env = dict(os.environ)
+    env.update(environment(auth0, imagekit))
+    # The app reads its settings on import, seed imports it too
+    os.environ.update(env)
+
+    print("Seeding {0} albums of {1} images".format(args.albums, args.images))
+    catalog = seed(args.albums, args.images)
+    tokens = [auth0.token() for _ in range(args.users)]
+
+    url = 'http://127.0.0.1:{0}'.format(args.port)
+    process = subprocess.Popen(
+        server_command(args), env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_until_ready(url, process)
+        print("Running {0} for {1}s with {2} clients against {3} {4} workers"
+              .format(args.scenario, args.duration, args.concurrency,
+                      args.workers, args.server))
+        run(SCENARIOS[args.scenario], url, tokens, catalog,
+            args.duration, args.concurrency)
+        print("ImageKit stand-in: {0}".format(imagekit.stats()))
+    finally:
+        process.terminate()
+        process.wait()
+        auth0.stop()
+        imagekit.stop()
+
+
+if __name__ == '__main__':
+    main()
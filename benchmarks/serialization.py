@@ -0,0 +1,112 @@
+'''
+Compares the serialization of GET /albums/<id>/images?all=true through
+ORM objects, getData() and jsonify (the path used before) against Core
+tuples encoded with serialization.dumps, buffered and streamed.
+
+It seeds an album for every size and measures the three paths in the
+process, without the HTTP overhead:
+
+    source .env_var
+    python -m benchmarks.serialization --sizes 1000 10000 100000
+
+WARNING: The database in DATABASE_URL is cleaned
+'''
+import argparse
+import time
+from flask import jsonify
+from sqlalchemy import insert
+from app import app, image_data, stream_listing, NO_IMAGES_TO_SHOW_MESSAGE
+from models import db, db_drop_and_create_all, Album, Image
+from serialization import json_response, orjson
+from benchmarks.stats import summarize
+
+SEED_CHUNK_SIZE = 10000
+
+
+def seed(sizes):
+    db_drop_and_create_all()
+    albumIds = []
+    for size in sizes:
+        album = Album(name="{0} images".format(size))
+        album.insert()
+        albumIds.append(album.id)
+        rows = [{
+            "w": 1600,
+            "h": 1200,
+            "url": "https://ik.imagekit.io/benchmark/{0}.jpeg".format(i),
+            "imageKitId": "benchmark_{0}_{1}".format(album.id, i),
+            "albumId": album.id,
+            "placeholder": "data:image/webp;base64," + "A" * 200,
+        } for i in range(size)]
+        for start in range(0, size, SEED_CHUNK_SIZE):
+            db.session.execute(
+                insert(Image), rows[start:start + SEED_CHUNK_SIZE])
+    db.session.commit()
+    return albumIds
+
+
+def orm_path(albumId):
+    rows = Image.query.filter_by(albumId=albumId).order_by(Image.id).all()
+    return jsonify({
+        "success": True,
+        "images": [image.getData() for image in rows],
+        "next_cursor": None,
+    }).get_data()
+
+
+def core_path(albumId):
+    statement = db.select(*Image.data_columns()).where(
+        Image.albumId == albumId).order_by(Image.id)
+    rows = db.session.execute(statement).all()
+    return json_response({
+        "success": True,
+        "images": [image_data(row) for row in rows],
+        "next_cursor": None,
+    }).get_data()
+
+
+def stream_path(albumId):
+    statement = db.select(*Image.data_columns()).where(
+        Image.albumId == albumId)
+    response = stream_listing(statement, Image.id, None, "images",
+                              image_data, NO_IMAGES_TO_SHOW_MESSAGE)
+    return b''.join(response.response)
+
+
+def measure(path, albumId, repetitions):
+    timings = []
+    body = None
+    for _ in range(repetitions):
+        # Every request starts with an empty identity map
+        db.session.remove()
+        start = time.perf_counter()
+        body = path(albumId)
+        timings.append(time.perf_counter() - start)
+    return timings, body
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--repetitions', type=int, default=10)
+    args = parser.parse_args()
+
+    print("JSON encoder: {0}".format("orjson" if orjson else "json"))
+    with app.app_context():
+        print("Seeding albums of {0} images".format(args.sizes))
+        albumIds = seed(args.sizes)
+    for size, albumId in zip(args.sizes, albumIds):
+        with app.test_request_context():
+            orm, ormBody = measure(orm_path, albumId, args.repetitions)
+            core, coreBody = measure(core_path, albumId, args.repetitions)
+            stream, streamBody = measure(
+                stream_path, albumId, args.repetitions)
+        assert ormBody.strip() == coreBody == streamBody
+        summarize("orm + jsonify {0}".format(size), orm)
+        summarize("core + dumps {0}".format(size), core)
+        summarize("core + streamed dumps {0}".format(size), stream)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+'''
+Measures the near-duplicate search of GET /albums/<id>/images/similar
+on the in-memory index of a single album of N random hashes, without
+the database:
+
+    python -m benchmarks.similar_images --images 100000
+'''
+import argparse
+import time
+import numpy as np
+from similarity import AlbumIndex
+from benchmarks.stats import summarize
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--max-distance', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(
+        -2 ** 63, 2 ** 63 - 1, args.images, dtype=np.int64)
+    rows = np.stack([np.arange(1, args.images + 1), hashes], axis=1)
+
+    start = time.perf_counter()
+    index = AlbumIndex(rows, 0)
+    summarize("load {0} hashes".format(args.images),
+              [time.perf_counter() - start])
+
+    timings = []
+    for query in rng.choice(hashes, args.queries):
+        start = time.perf_counter()
+        index.search(int(query), args.max_distance, 100)
+        timings.append(time.perf_counter() - start)
+    summarize("search {0} hashes".format(args.images), timings)
+
+    timings = []
+    for imageId in range(args.images + 1, args.images + args.queries + 1):
+        start = time.perf_counter()
+        index.add(imageId, imageId)
+        index.remove(imageId - args.images)
+        timings.append(time.perf_counter() - start)
+    summarize("add and remove", timings)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import math
+
+
+def percentile(values, p):
+    '''
+    Nearest-rank percentile, p in [0, 100]
+    '''
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(name, timings):
+    '''
+    Prints p50/p95/p99 of a list of timings given in seconds
+    '''
+    print("{0:<40} n={1:<6} p50={2:8.2f}ms p95={3:8.2f}ms p99={4:8.2f}ms"
+          .format(
+              name,
+              len(timings),
+              percentile(timings, 50) * 1000,
+              percentile(timings, 95) * 1000,
+              percentile(timings, 99) * 1000))
@@ -0,0 +1,194 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import g, request, Response
+
+
+class LRUCache():
+    '''
+    Thread safe LRU cache
+    Every entry can carry an absolute expiration time (epoch seconds),
+    expired entries are dropped when they are looked up.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at=None):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ResponseCache():
+    '''
+    Size bounded LRU cache of serialized GET responses
+    Entries are tagged (e.g. with the album id) so writes can invalidate
+    exactly the listings they affect. Every gunicorn worker has its own
+    cache, so entries also expire after ttl seconds to bound how long a
+    worker can serve a listing changed through another worker.
+    '''
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def remove(self, key):
+        body, tags, _ = self.entries.pop(key)
+        self.size -= len(key) + len(body)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.tags[tag]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] <= time.time():
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, body, tags):
+        entrySize = len(key) + len(body)
+        if entrySize > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (body, tags, time.time() + self.ttl)
+            self.size += entrySize
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self.remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+            self.size = 0
+
+    def cached(self, tags):
+        '''
+        Decorator for GET views, tags receives the view arguments and
+        returns the tags of the response. Only 200 responses are cached,
+        streamed ones are not, so they are never buffered in memory.
+        Under conditional the ETag is part of the key, so entries of an
+        outdated version are never served.
+        '''
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                key = request.full_path + '#' + g.get('etag', '')
+                body = self.get(key)
+                if body is not None:
+                    return Response(body, mimetype='application/json')
+                response = f(*args, **kwargs)
+                if response.status_code == 200 and not response.is_streamed:
+                    self.set(key, response.get_data(), tags(**kwargs))
+                return response
+            return wrapper
+        return cached_decorator
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def conditional(etag):
+    '''
+    Decorator for GET views, etag receives the view arguments and returns
+    the strong ETag of the current representation. If-None-Match is
+    answered with 304 without calling the view.
+    '''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            value = etag(**kwargs)
+            if request.if_none_match.contains_weak(value):
+                response = Response(status=304)
+                response.set_etag(value)
+                return response
+            g.etag = value
+            response = f(*args, **kwargs)
+            if response.status_code == 200:
+                response.set_etag(value)
+            return response
+        return wrapper
+    return conditional_decorator
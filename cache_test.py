@@ -0,0 +1,60 @@
+import time
+import unittest
+from cache import LRUCache, ResponseCache
+
+
+class LRUCacheTests(unittest.TestCase):
+    def testLeastRecentlyUsedIsEvicted(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def testExpiredEntriesAreMisses(self):
+        cache = LRUCache(2)
+        cache.set('a', 1, time.time() - 1)
+        cache.set('b', 2, time.time() + 60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(len(cache), 1)
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def testInvalidateByTag(self):
+        cache = ResponseCache(1024, 60)
+        cache.set('/albums', b'albums', ['albums'])
+        cache.set('/albums/1/images', b'images 1', ['album:1'])
+        cache.set('/albums/2/images', b'images 2', ['album:2'])
+        cache.invalidate('album:1')
+        self.assertEqual(cache.get('/albums'), b'albums')
+        self.assertIsNone(cache.get('/albums/1/images'))
+        self.assertEqual(cache.get('/albums/2/images'), b'images 2')
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+    def testSizeIsBounded(self):
+        cache = ResponseCache(30, 60)
+        cache.set('a', b'x' * 10, ['a'])
+        cache.set('b', b'x' * 10, ['b'])
+        cache.set('c', b'x' * 10, ['c'])
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 22)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        cache.invalidate('a')
+        self.assertEqual(cache.stats()['entries'], 2)
+
+    def testEntriesExpire(self):
+        cache = ResponseCache(1024, 0)
+        cache.set('/albums', b'albums', ['albums'])
+        self.assertIsNone(cache.get('/albums'))
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+'''
+Settings of `gunicorn app:app`, read from the working directory.
+
+The app is imported once in the master and the workers are forked from
+it. warm_up loads in the master what importing the app leaves for the
+first requests, so the workers start with it and share its memory.
+PRELOAD_APP=false imports the app in every worker instead, e.g. to
+reload the code by restarting the workers.
+'''
+import os
+
+preload_app = os.environ.get('PRELOAD_APP', 'true') == 'true'
+
+
+def when_ready(server):
+    # Runs in the master, before the workers are forked
+    if preload_app:
+        from app import warm_up
+        warm_up()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from app import after_fork
+        after_fork()
@@ -1,13 +1,299 @@
-from imagekitio import ImageKit
-from imagekitio.models.UploadFileRequestOptions import UploadFileRequestOptions
 from base64 import b64encode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pprint import pprint
+import asyncio
+import hashlib
+import io
+import multiprocessing
 import os
 import functools
+import shutil
+import tempfile
+import threading
+import time
+from cache import LRUCache
+from metrics import registry
+from storage import Storage, FileSystemStorage
+from transport import AsyncTransport, Transport
 
+# The benchmarks point them to a local stand-in
+IMAGEKIT_API_BASE_URL = os.environ.get(
+    'IMAGEKIT_API_BASE_URL', 'https://api.imagekit.io')
+IMAGEKIT_UPLOAD_BASE_URL = os.environ.get(
+    'IMAGEKIT_UPLOAD_BASE_URL', 'https://upload.imagekit.io')
+
+# imagekit or filesystem
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'imagekit')
+UPLOAD_WORKERS = int(os.environ.get('IMAGEKIT_UPLOAD_WORKERS', 8))
+UPLOAD_URL = IMAGEKIT_UPLOAD_BASE_URL + "/api/v1/files/upload"
+BULK_DELETE_URL = IMAGEKIT_API_BASE_URL + "/v1/files/batch/deleteByFileIds"
+# Maximum number of files imagekit deletes in a single request
+BULK_DELETE_MAX_FILES = 100
+# A hung connection must not block a worker forever. Only idempotent
+# calls are retried, and the circuit fails them fast after
+# IMAGEKIT_CIRCUIT_FAILURES consecutive errors for IMAGEKIT_CIRCUIT_RESET
+# seconds.
+IMAGEKIT_CONNECT_TIMEOUT = float(
+    os.environ.get('IMAGEKIT_CONNECT_TIMEOUT', 3.05))
+IMAGEKIT_READ_TIMEOUT = float(os.environ.get('IMAGEKIT_READ_TIMEOUT', 30))
+IMAGEKIT_RETRIES = int(os.environ.get('IMAGEKIT_RETRIES', 2))
+IMAGEKIT_BACKOFF = float(os.environ.get('IMAGEKIT_BACKOFF', 0.2))
+IMAGEKIT_BACKOFF_MAX = float(os.environ.get('IMAGEKIT_BACKOFF_MAX', 2))
+IMAGEKIT_CIRCUIT_FAILURES = int(
+    os.environ.get('IMAGEKIT_CIRCUIT_FAILURES', 5))
+IMAGEKIT_CIRCUIT_RESET = float(os.environ.get('IMAGEKIT_CIRCUIT_RESET', 30))
+# Connections of the ASGI app, where every upload in flight can hold one
+IMAGEKIT_ASYNC_POOL_SIZE = int(os.environ.get('IMAGEKIT_ASYNC_POOL_SIZE', 100))
+
+PREPROCESS_IMAGES = os.environ.get('PREPROCESS_IMAGES', 'true') == 'true'
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', 2048))
+# WEBP or JPEG
+IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT', 'WEBP').upper()
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 82))
+PREPROCESS_WORKERS = int(
+    os.environ.get('IMAGE_PREPROCESS_WORKERS', os.cpu_count() or 1))
+# Longest edge of the low quality placeholders sent with the images
+PLACEHOLDER_SIZE = int(os.environ.get('IMAGE_PLACEHOLDER_SIZE', 16))
+
+# Widths of the resized copies offered in the srcset of an image
+SRCSET_WIDTHS = [
+    int(width) for width in
+    os.environ.get('SRCSET_WIDTHS', '320,640,1024,1600').split(',')
+]
+URL_CACHE_SIZE = int(os.environ.get('IMAGEKIT_URL_CACHE_SIZE', 50000))
+SIGNED_URLS = os.environ.get('IMAGEKIT_SIGNED_URLS', 'false') == 'true'
+# Signed URLs are valid between SIGNED_URL_TTL and twice that time
+SIGNED_URL_TTL = int(os.environ.get('IMAGEKIT_SIGNED_URL_TTL', 3600))
+
+IMAGEKIT_REQUEST_SECONDS = registry.histogram(
+    'imagekit_request_seconds', 'Duration of the imagekit requests')
+IMAGEKIT_REQUEST_FAILURES = registry.counter(
+    'imagekit_request_failures_total', 'Failed imagekit requests')
+IMAGE_PROCESSING_SECONDS = registry.histogram(
+    'image_processing_seconds',
+    'Duration of the image processing in the process pool')
+
+
+def signed_url_epoch():
+    '''
+    Signed URLs built in the same epoch expire at the same time, so they
+    are the same for every worker and request of the epoch
+    '''
+    return int(time.time()) // SIGNED_URL_TTL
+
+
+def preprocess_image(path, max_edge, image_format, quality):
+    '''
+    Runs in the preprocessing processes. Applies the EXIF orientation,
+    caps the longest edge and re-encodes the image without metadata (the
+    ICC profile is kept so colors do not change). Returns the encoded
+    image, its width and height, or None for images that can not be
+    re-encoded without losing something (e.g. animations).
+    '''
+    from PIL import Image as PILImage
+    with PILImage.open(path) as image:
+        if getattr(image, 'is_animated', False):
+            return None
+        image, iccProfile = decode_image(image, max_edge)
+        return reencode_image(
+            image, iccProfile, max_edge, image_format, quality)
+
+
+def decode_image(image, max_edge):
+    '''
+    Decodes the opened image with its EXIF orientation applied, letting
+    the JPEG decoder downscale to about max_edge. Returns it with its ICC
+    profile.
+    '''
+    from PIL import ImageOps
+    image.draft('RGB', (max_edge, max_edge))
+    iccProfile = image.info.get('icc_profile')
+    return ImageOps.exif_transpose(image), iccProfile
+
+
+def reencode_image(image, iccProfile, max_edge, image_format, quality):
+    from PIL import Image as PILImage
+    hasAlpha = 'A' in image.getbands() or 'transparency' in image.info
+    if image_format == 'WEBP' and hasAlpha:
+        image = image.convert('RGBA')
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((max_edge, max_edge), PILImage.LANCZOS)
+    output = io.BytesIO()
+    image.save(
+        output,
+        format=image_format,
+        quality=quality,
+        icc_profile=iccProfile
+    )
+    return output.getvalue(), image.width, image.height
+
+
+def perceptual_hash(path):
+    '''
+    Runs in the preprocessing processes. Returns the difference_hash of
+    the image, None if it can not be decoded.
+    '''
+    from PIL import Image as PILImage
+    try:
+        with PILImage.open(path) as image:
+            image, _ = decode_image(image, 64)
+            return difference_hash(image)
+    except Exception:
+        return None
+
+
+def difference_hash(image):
+    '''
+    Returns the 64 bit difference hash of a decoded image as a signed
+    integer: the image is reduced to 9x8 grays and every bit tells whether
+    a pixel is brighter than the next one, so resized or recompressed
+    copies get close hashes.
+    '''
+    import cv2
+    import numpy as np
+    gray = np.asarray(image.convert('L'))
+    gray = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(gray[:, 1:] > gray[:, :-1])
+    return int(bits.view('>i8')[0])
+
+
+def placeholder_image(file, size):
+    '''
+    Returns a tiny blurry version of the image as a WEBP data URI (a few
+    hundred bytes), shown by the frontend until the image is loaded. file
+    is a path or a binary file object.
+    '''
+    from PIL import Image as PILImage
+    with PILImage.open(file) as image:
+        image, _ = decode_image(image, size)
+        return placeholder_of(image, size)
+
+
+def placeholder_of(image, size):
+    from PIL import Image as PILImage
+    image = image.convert('RGB')
+    image.thumbnail((size, size), PILImage.BILINEAR)
+    output = io.BytesIO()
+    image.save(output, format='WEBP', quality=40)
+    return 'data:image/webp;base64,' + b64encode(output.getvalue()).decode()
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def process_image(path, preprocess, max_edge, image_format, quality,
+                  placeholder_size):
+    '''
+    Runs in the preprocessing processes. Decodes the upload once and
+    returns its contentHash, the perceptualHash and placeholder of the
+    original and, when preprocess is set, the preprocess_image output as
+    processed. Each value is None if it can not be computed.
+    '''
+    from PIL import Image as PILImage
+    result = {
+        "contentHash": file_hash(path),
+        "perceptualHash": None,
+        "placeholder": None,
+        "processed": None,
+    }
+    try:
+        with PILImage.open(path) as image:
+            animated = getattr(image, 'is_animated', False)
+            image, iccProfile = decode_image(
+                image, max_edge if preprocess else 4 * placeholder_size)
+            result["perceptualHash"] = difference_hash(image)
+            result["placeholder"] = placeholder_of(image, placeholder_size)
+            if preprocess and not animated:
+                result["processed"] = reencode_image(
+                    image, iccProfile, max_edge, image_format, quality)
+    except Exception as e:
+        print("\nPREPROCESS_EXCEPTION:", e, end='\n\n')
+    return result
+
+
+def times_imagekit_request(function):
+    '''
+    Records the duration of the request, and counts it as failed when the
+    returned dictionary is not successful. Coroutines are timed until
+    they finish.
+    '''
+    def record(start, response):
+        IMAGEKIT_REQUEST_SECONDS.observe(
+            time.perf_counter() - start, operation=function.__name__)
+        if not response['success']:
+            IMAGEKIT_REQUEST_FAILURES.inc(operation=function.__name__)
+        return response
+
+    if asyncio.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def coroutine(*args, **kwargs):
+            start = time.perf_counter()
+            return record(start, await function(*args, **kwargs))
+        return coroutine
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        return record(start, function(*args, **kwargs))
+    return wrapper
+
+
+class StreamedFile():
+    '''
+    Read-only view of a binary file that tells the multipart encoder how
+    many bytes are left, so the file is sent in chunks instead of being
+    copied or loaded in memory
+    '''
+    def __init__(self, file):
+        self.file = file
+        position = file.tell()
+        self.size = file.seek(0, os.SEEK_END)
+        file.seek(position)
+
+    @property
+    def len(self):
+        return self.size - self.file.tell()
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+
+class HashingFile():
+    '''
+    Wraps the file where an upload is spooled and computes the SHA-256 of
+    its content while it is written
+    '''
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class ImageKitStorage(Storage):
+    '''
+    Stores the images in imagekit, which resizes them on the fly
+    '''
+    resizes = True
 
-class ImageControl():
     def __init__(self):
+        # Imported here, the SDK is slow to import
+        from imagekitio import ImageKit
+        from imagekitio.constants.url import URL
         self.PRIVATE_KEY = os.environ.get('IMAGEKIT_PRIVATE_KEY', '')
         self.PUBLIC_KEY = os.environ.get('IMAGEKIT_PUBLIC_KEY', '')
         self.URL_ENDPOINT = os.environ.get('IMAGEKIT_URL_ENDPOINT', '')
@@ -22,11 +308,30 @@ class ImageControl():
         assert len(self.PUBLIC_KEY) > 0, PUBLIC_KEY_MESSAGE
         assert len(self.URL_ENDPOINT) > 0, URL_ENDPOINT_MESSAGE
 
+        # The SDK reads its base URLs from URL on every request
+        URL.API_BASE_URL = IMAGEKIT_API_BASE_URL
+        URL.UPLOAD_BASE_URL = IMAGEKIT_UPLOAD_BASE_URL
         self.imagekit = ImageKit(
             private_key=self.PRIVATE_KEY,
             public_key=self.PUBLIC_KEY,
             url_endpoint=self.URL_ENDPOINT
         )
+        self.transport = Transport(
+            'imagekit',
+            IMAGEKIT_CONNECT_TIMEOUT,
+            IMAGEKIT_READ_TIMEOUT,
+            IMAGEKIT_RETRIES,
+            IMAGEKIT_BACKOFF,
+            IMAGEKIT_BACKOFF_MAX,
+            # Every upload thread can hold a connection
+            UPLOAD_WORKERS,
+            IMAGEKIT_CIRCUIT_FAILURES,
+            IMAGEKIT_CIRCUIT_RESET
+        )
+        # The SDK calls go through the pool too
+        self.imagekit.ik_request.request = self.transport.request
+        # Created by open_async in the event loop of the ASGI app
+        self.async_transport = None
 
     def makes_request_to_imagekit(function):
         @functools.wraps(function)
@@ -44,24 +349,384 @@ class ImageControl():
                     "success": False,
                     "message": e,
                 }
-        return wrapper
+        return times_imagekit_request(wrapper)
+
+    @times_imagekit_request
+    def upload(self, file, image_name):
+        '''
+        Uploads a binary file object as multipart/form-data, the body is
+        streamed from the file so the peak memory does not depend on the
+        size of the image
+        '''
+        from requests_toolbelt import MultipartEncoder
+        try:
+            encoder = MultipartEncoder(fields={
+                "file": (image_name, StreamedFile(file),
+                         "application/octet-stream"),
+                "fileName": image_name,
+                "isPrivateFile": "false",
+            })
+            headers = self.imagekit.ik_request.create_headers()
+            headers["Content-Type"] = encoder.content_type
+            response = self.transport.request(
+                'POST', UPLOAD_URL, data=encoder, headers=headers)
+            if response.status_code != 200:
+                raise Exception(response.json().get('message', response.text))
+            return {
+                "success": True,
+                "metadata": response.json(),
+            }
+        except Exception as e:
+            print("\nIMAGEKIT_EXCEPTION:", e, end='\n\n')
+            return {
+                "success": False,
+                "message": e,
+            }
+
+    @times_imagekit_request
+    async def upload_async(self, file, image_name):
+        '''
+        upload for the ASGI app, the event loop is free while imagekit
+        answers
+        '''
+        try:
+            headers = self.imagekit.ik_request.create_headers()
+            response = await self.async_transport.request(
+                'POST',
+                UPLOAD_URL,
+                files={"file": (image_name, file, "application/octet-stream")},
+                data={"fileName": image_name, "isPrivateFile": "false"},
+                headers=headers
+            )
+            if response.status_code != 200:
+                raise Exception(response.json().get('message', response.text))
+            return {
+                "success": True,
+                "metadata": response.json(),
+            }
+        except Exception as e:
+            print("\nIMAGEKIT_EXCEPTION:", e, end='\n\n')
+            return {
+                "success": False,
+                "message": e,
+            }
 
     @makes_request_to_imagekit
-    def upload_64_encoded_image(self, encodedImage, image_name):
-        options = UploadFileRequestOptions(is_private_file=False)
-        return self.imagekit.upload_file(
-            file=encodedImage,
-            file_name=image_name,
-            options=options
+    def delete(self, fileId):
+        return self.imagekit.delete_file(file_id=fileId)
+
+    @times_imagekit_request
+    async def delete_async(self, fileId):
+        try:
+            response = await self.async_transport.request(
+                'DELETE',
+                "{0}/v1/files/{1}".format(IMAGEKIT_API_BASE_URL, fileId),
+                headers=self.imagekit.ik_request.create_headers()
+            )
+            if response.status_code not in [200, 204]:
+                raise Exception(response.json().get('message', response.text))
+            return {
+                "success": True,
+                "metadata": {},
+            }
+        except Exception as e:
+            print("\nIMAGEKIT_EXCEPTION:", e, end='\n\n')
+            return {
+                "success": False,
+                "message": e,
+            }
+
+    async def open_async(self):
+        # Shares the circuit with the blocking transport, imagekit is down
+        # for both
+        self.async_transport = AsyncTransport(
+            'imagekit',
+            IMAGEKIT_CONNECT_TIMEOUT,
+            IMAGEKIT_READ_TIMEOUT,
+            IMAGEKIT_RETRIES,
+            IMAGEKIT_BACKOFF,
+            IMAGEKIT_BACKOFF_MAX,
+            IMAGEKIT_ASYNC_POOL_SIZE,
+            IMAGEKIT_CIRCUIT_FAILURES,
+            IMAGEKIT_CIRCUIT_RESET,
+            breaker=self.transport.breaker
+        )
+
+    async def close_async(self):
+        if self.async_transport is not None:
+            await self.async_transport.aclose()
+            self.async_transport = None
+
+    @times_imagekit_request
+    def bulk_delete(self, fileIds):
+        '''
+        Deletes up to BULK_DELETE_MAX_FILES files in a single request.
+        deleted has the ids that are not in imagekit anymore, including
+        the ones that were already missing.
+        '''
+        try:
+            headers = self.imagekit.ik_request.create_headers()
+            # Deleting the same files again is harmless
+            response = self.transport.request(
+                'POST',
+                BULK_DELETE_URL,
+                idempotent=True,
+                json={"fileIds": fileIds},
+                headers=headers
+            )
+            data = response.json()
+            if response.status_code not in [200, 207, 404]:
+                raise Exception(data.get('message', response.text))
+            deleted = data.get('successfullyDeletedFileIds', []) + \
+                data.get('missingFileIds', [])
+            return {
+                "success": len(deleted) == len(fileIds),
+                "deleted": deleted,
+                "message": data.get('message'),
+            }
+        except Exception as e:
+            print("\nIMAGEKIT_EXCEPTION:", e, end='\n\n')
+            return {
+                "success": False,
+                "deleted": [],
+                "message": e,
+            }
+
+    def thumbnail_url(self, url, size):
+        '''
+        URL of the image resized by imagekit so its longest edge is size
+        '''
+        return self.imagekit.url({
+            "src": url,
+            "transformation": [{
+                "width": str(size),
+                "height": str(size),
+                "crop": "at_max",
+            }],
+        })
+
+    def stats(self):
+        stats = self.transport.stats()
+        if self.async_transport is not None:
+            asyncStats = self.async_transport.stats()
+            stats["retries"] += asyncStats["retries"]
+            stats["rejected"] += asyncStats["rejected"]
+        return stats
+
+    def url(self, fileId, url, width=None):
+        '''
+        Signed with IMAGEKIT_SIGNED_URLS, signed urls built in the same
+        epoch are the same and expire at its end
+        '''
+        options = {"src": url}
+        if width is not None:
+            options["transformation"] = [{"width": str(width)}]
+        expiresAt = None
+        if SIGNED_URLS:
+            epoch = signed_url_epoch()
+            expiresAt = (epoch + 1) * SIGNED_URL_TTL
+            options["signed"] = True
+            options["expire_seconds"] = \
+                expiresAt + SIGNED_URL_TTL - int(time.time())
+        return self.imagekit.url(options), expiresAt
+
+
+def create_storage():
+    if STORAGE_BACKEND == 'filesystem':
+        return FileSystemStorage()
+    return ImageKitStorage()
+
+
+class ImageControl():
+    '''
+    Prepares the images and keeps them in the storage of STORAGE_BACKEND
+    '''
+    def __init__(self, storage=None):
+        # Created on first use, importing app stays fast and gunicorn
+        # can preload it without opening connections
+        self._storage = storage
+        self.storage_lock = threading.Lock()
+        # Shared by all the requests, bounds the concurrent uploads
+        self.upload_executor = ThreadPoolExecutor(
+            max_workers=UPLOAD_WORKERS,
+            thread_name_prefix='upload'
+        )
+        # Building and signing urls is done for every row of the listings
+        self.url_cache = LRUCache(URL_CACHE_SIZE)
+        # Created on first use, so gunicorn workers do not share it
+        self.preprocess_executor = None
+        self.preprocess_executor_lock = threading.Lock()
+
+    @property
+    def storage(self):
+        if self._storage is None:
+            with self.storage_lock:
+                if self._storage is None:
+                    self._storage = create_storage()
+        return self._storage
+
+    def get_preprocess_executor(self):
+        with self.preprocess_executor_lock:
+            if self.preprocess_executor is None:
+                self.preprocess_executor = ProcessPoolExecutor(
+                    max_workers=PREPROCESS_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self.preprocess_executor
+
+    def run_in_pool(self, file, function, *args):
+        '''
+        Runs function(path, *args) in the process pool, so the request
+        threads are not blocked by the GIL. Files that are not in the disk
+        are copied to a temporary file. Returns None if it fails.
+        '''
+        path = getattr(file, 'name', None)
+        temporary = None
+        try:
+            if not isinstance(path, str) or not os.path.isfile(path):
+                temporary = tempfile.NamedTemporaryFile(delete=False)
+                with temporary:
+                    shutil.copyfileobj(file, temporary)
+                path = temporary.name
+            with IMAGE_PROCESSING_SECONDS.time(function=function.__name__):
+                future = self.get_preprocess_executor().submit(
+                    function, path, *args)
+                return future.result()
+        except Exception as e:
+            print("\nPREPROCESS_EXCEPTION:", e, end='\n\n')
+            return None
+        finally:
+            file.seek(0)
+            if temporary is not None:
+                os.remove(temporary.name)
+
+    def process(self, file):
+        '''
+        process_image of the file in a single task of the process pool,
+        preprocessed when PREPROCESS_IMAGES is set
+        '''
+        result = self.run_in_pool(
+            file,
+            process_image,
+            PREPROCESS_IMAGES,
+            IMAGE_MAX_EDGE,
+            IMAGE_FORMAT,
+            IMAGE_QUALITY,
+            PLACEHOLDER_SIZE
         )
+        return result or {
+            "contentHash": None,
+            "perceptualHash": None,
+            "placeholder": None,
+            "processed": None,
+        }
+
+    def upload_file(self, file, image_name):
+        '''
+        Uploads a binary file object, preprocessed when PREPROCESS_IMAGES
+        is set. width and height of the response are the ones of the
+        uploaded image, contentHash, perceptualHash and placeholder the
+        ones of the original.
+        '''
+        analysis = self.process(file)
+        processed = analysis.pop("processed")
+        file, image_name = self.processed_file(file, image_name, processed)
+        response = self.storage.upload(file, image_name)
+        return self.upload_response(response, analysis, processed)
+
+    async def upload_file_async(self, file, image_name):
+        '''
+        upload_file for the ASGI app. The process pool is waited in a
+        thread and the upload is awaited.
+        '''
+        analysis = await asyncio.to_thread(self.process, file)
+        processed = analysis.pop("processed")
+        file, image_name = self.processed_file(file, image_name, processed)
+        response = await self.storage.upload_async(file, image_name)
+        return self.upload_response(response, analysis, processed)
+
+    def processed_file(self, file, image_name, processed):
+        if processed is None:
+            return file, image_name
+        image_name = os.path.splitext(image_name)[0] + '.' + \
+            IMAGE_FORMAT.lower()
+        return io.BytesIO(processed[0]), image_name
+
+    def upload_response(self, response, analysis, processed):
+        if response['success']:
+            metadata = response['metadata']
+            _, width, height = processed or \
+                (None, metadata['width'], metadata['height'])
+            response['width'] = width
+            response['height'] = height
+            response.update(analysis)
+        return response
 
     def upload_image(self, image, image_name):
-        encodedImage = b64encode(image)
-        return self.upload_64_encoded_image(encodedImage, image_name)
+        return self.upload_file(io.BytesIO(image), image_name)
 
-    @makes_request_to_imagekit
-    def delete_image(self, image_id):
-        return self.imagekit.delete_file(file_id=image_id)
+    def upload_images(self, files):
+        '''
+        Uploads concurrently the (file, image_name) pairs, files are
+        streamed by the upload threads. The responses keep the input order.
+        '''
+        return list(self.upload_executor.map(self.upload_file, *zip(*files)))
+
+    def thumbnail_url(self, url, size):
+        return self.storage.thumbnail_url(url, size)
+
+    def transformation_url(self, fileId, url, width=None):
+        '''
+        URL of the image resized to width, the original for None.
+        Memoized by (fileId, width), until the URL expires.
+        '''
+        if width is None and not SIGNED_URLS:
+            return url
+        key = (fileId, width)
+        transformed = self.url_cache.get(key)
+        if transformed is not None:
+            return transformed
+        transformed, expiresAt = self.storage.url(fileId, url, width)
+        self.url_cache.set(key, transformed, expiresAt)
+        return transformed
+
+    def srcset(self, imageKitId, url, width):
+        '''
+        srcset of the image, with the SRCSET_WIDTHS smaller than its width
+        and the original. Only the original if the storage does not
+        resize.
+        '''
+        widths = SRCSET_WIDTHS if self.storage.resizes else []
+        candidates = [
+            '{0} {1}w'.format(
+                self.transformation_url(imageKitId, url, candidate),
+                candidate)
+            for candidate in widths if candidate < width
+        ]
+        candidates.append('{0} {1}w'.format(
+            self.transformation_url(imageKitId, url), width))
+        return ', '.join(candidates)
+
+    def delete_image(self, fileId):
+        return self.storage.delete(fileId)
+
+    async def delete_image_async(self, fileId):
+        return await self.storage.delete_async(fileId)
+
+    def bulk_delete_images(self, fileIds):
+        '''
+        Deletes the files in requests of up to BULK_DELETE_MAX_FILES,
+        message is the one of the last request that failed
+        '''
+        response = {"success": True, "deleted": [], "message": None}
+        for start in range(0, len(fileIds), BULK_DELETE_MAX_FILES):
+            chunk = self.storage.bulk_delete(
+                fileIds[start:start + BULK_DELETE_MAX_FILES])
+            response["deleted"] += chunk['deleted']
+            if not chunk['success']:
+                response["success"] = False
+                response["message"] = chunk['message']
+        return response
 
 
 if __name__ == '__main__':
@@ -1,6 +1,15 @@
 import unittest
+import hashlib
+import io
 import os
-from image_control import ImageControl
+import shutil
+import tempfile
+from base64 import b64decode
+from PIL import Image as PILImage
+import image_control
+from storage import FileSystemStorage
+from image_control import ImageControl, preprocess_image, perceptual_hash, \
+    placeholder_image, process_image
 
 
 class ImageControlTests(unittest.TestCase):
@@ -30,5 +39,150 @@ class ImageControlTests(unittest.TestCase):
         self.assertTrue(response['message'])
 
 
+class PreprocessTests(unittest.TestCase):
+    def testDownscaleAndReencode(self):
+        encoded, w, h = preprocess_image('avatar_1.jpg', 300, 'WEBP', 80)
+        self.assertEqual((w, h), (300, 300))
+        image = PILImage.open(io.BytesIO(encoded))
+        self.assertEqual(image.format, 'WEBP')
+        self.assertEqual(image.size, (300, 300))
+
+    def testExifOrientationIsAppliedAndStripped(self):
+        exif = PILImage.Exif()
+        exif[0x0112] = 6
+        with tempfile.NamedTemporaryFile(suffix='.jpeg') as f:
+            PILImage.new('RGB', (200, 100)).save(f, 'JPEG', exif=exif)
+            f.flush()
+            encoded, w, h = preprocess_image(f.name, 1000, 'JPEG', 80)
+        self.assertEqual((w, h), (100, 200))
+        image = PILImage.open(io.BytesIO(encoded))
+        self.assertEqual(len(image.getexif()), 0)
+
+    def testProcessInProcessPool(self):
+        with open('avatar_1.jpg', 'rb') as f:
+            content = f.read()
+        stream = io.BytesIO(content)
+        result = ImageControl().process(stream)
+        encoded, w, h = result["processed"]
+        self.assertEqual((w, h), (900, 900))
+        self.assertEqual(stream.tell(), 0)
+        self.assertEqual(
+            result["contentHash"], hashlib.sha256(content).hexdigest())
+        # Decoded at another scale, the hash is nearly the same
+        difference = result["perceptualHash"] ^ perceptual_hash('avatar_1.jpg')
+        self.assertLessEqual(
+            bin(difference & (2 ** 64 - 1)).count('1'), 2)
+        self.assertTrue(
+            result["placeholder"].startswith('data:image/webp;base64,'))
+
+    def testProcessKeepsAnimations(self):
+        frames = [PILImage.new('RGB', (32, 32), color)
+                  for color in ['red', 'blue']]
+        with tempfile.NamedTemporaryFile(suffix='.gif') as f:
+            frames[0].save(f, 'GIF', save_all=True, append_images=frames[1:])
+            f.flush()
+            result = process_image(f.name, True, 300, 'WEBP', 80, 16)
+        self.assertIsNone(result["processed"])
+        self.assertIsNotNone(result["placeholder"])
+
+    def testPerceptualHashOfResizedCopy(self):
+        with tempfile.NamedTemporaryFile(suffix='.jpeg') as f:
+            PILImage.open('avatar_1.jpg').resize((300, 300)).save(
+                f, 'JPEG', quality=50)
+            f.flush()
+            resized = perceptual_hash(f.name)
+        original = perceptual_hash('avatar_1.jpg')
+        distance = bin((original ^ resized) & (2 ** 64 - 1)).count('1')
+        self.assertLessEqual(distance, 4)
+        self.assertIsNone(perceptual_hash('requirements.txt'))
+
+    def testPlaceholderIsTiny(self):
+        placeholder = placeholder_image('avatar_1.jpg', 16)
+        self.assertTrue(placeholder.startswith('data:image/webp;base64,'))
+        self.assertLess(len(placeholder), 1024)
+        encoded = b64decode(placeholder.split(',')[1])
+        self.assertEqual(PILImage.open(io.BytesIO(encoded)).size, (16, 16))
+
+
+class LazyStorageTests(unittest.TestCase):
+    def testStorageIsCreatedOnFirstUse(self):
+        ik = ImageControl()
+        self.assertIsNone(ik._storage)
+        storage = ik.storage
+        self.assertIs(ik.storage, storage)
+
+
+class BulkDeleteStorage(FileSystemStorage):
+    def __init__(self, failing):
+        self.failing = failing
+        self.requests = []
+
+    def bulk_delete(self, fileIds):
+        self.requests.append(fileIds)
+        deleted = [fileId for fileId in fileIds if fileId not in self.failing]
+        return {
+            "success": len(deleted) == len(fileIds),
+            "deleted": deleted,
+            "message": "failed",
+        }
+
+
+class BulkDeleteTests(unittest.TestCase):
+    def testFilesAreDeletedInChunks(self):
+        storage = BulkDeleteStorage(failing={'file_150'})
+        ik = ImageControl(storage)
+        fileIds = ['file_{0}'.format(i) for i in range(250)]
+        response = ik.bulk_delete_images(fileIds)
+        self.assertEqual(
+            [len(chunk) for chunk in storage.requests], [100, 100, 50])
+        self.assertFalse(response['success'])
+        self.assertEqual(len(response['deleted']), 249)
+        self.assertEqual(response['message'], 'failed')
+
+
+class SrcsetTests(unittest.TestCase):
+    def setUp(self):
+        self.ik = ImageControl()
+        self.url = self.ik.storage.URL_ENDPOINT + '/image_a.jpeg'
+
+    def tearDown(self):
+        image_control.SIGNED_URLS = False
+
+    def testSrcsetWidthsAreSmallerThanTheImage(self):
+        srcset = self.ik.srcset('a', self.url, 700)
+        candidates = [candidate.split(' ') for candidate in srcset.split(', ')]
+        self.assertEqual([width for _, width in candidates],
+                         ['320w', '640w', '700w'])
+        self.assertIn('tr=w-320', candidates[0][0])
+        self.assertEqual(candidates[-1][0], self.url)
+
+    def testSrcsetWithoutResizingHasTheOriginal(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        ik = ImageControl(FileSystemStorage(directory))
+        self.assertEqual(ik.srcset('a', '/media/a.jpeg', 700),
+                         '/media/a.jpeg 700w')
+
+    def testUrlsAreMemoized(self):
+        self.ik.transformation_url('a', self.url, 320)
+        self.ik.transformation_url('a', self.url, 320)
+        self.ik.transformation_url('a', self.url, 640)
+        self.assertEqual(self.ik.url_cache.stats()['hits'], 1)
+        self.assertEqual(self.ik.url_cache.stats()['size'], 2)
+
+    def testSignedUrlsExpireWithTheEpoch(self):
+        image_control.SIGNED_URLS = True
+        url = self.ik.transformation_url('a', self.url, 320)
+        self.assertIn('ik-s=', url)
+        self.assertEqual(self.ik.transformation_url('a', self.url, 320), url)
+        _, expiresAt = self.ik.url_cache.entries[('a', 320)]
+        epoch = image_control.signed_url_epoch()
+        self.assertEqual(expiresAt, (epoch + 1) * image_control.SIGNED_URL_TTL)
+        expiresIn = int(url.split('ik-t=')[1].split('&')[0]) - expiresAt
+        # The SDK reads the clock again, it can be a second later
+        self.assertIn(expiresIn, [image_control.SIGNED_URL_TTL,
+                                  image_control.SIGNED_URL_TTL + 1])
+
+
 if __name__ == "__main__":
     unittest.main()
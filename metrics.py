@@ -0,0 +1,373 @@
+import bisect
+import fcntl
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Shared by the gunicorn workers of the host, every process writes its
+# metrics there and /metrics adds them up
+METRICS_DIR = os.environ.get(
+    'METRICS_DIR', os.path.join(tempfile.gettempdir(), 'capstone_metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+# Sum of the snapshots of the processes that are gone
+MERGED_SNAPSHOT = 'merged.json'
+
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def snapshot_of(counters, histograms):
+    return {
+        "counters": [
+            [name, labels, value]
+            for (name, labels), value in counters.items()
+        ],
+        "histograms": [
+            [name, labels, list(counts), total]
+            for (name, labels), (counts, total) in histograms.items()
+        ],
+    }
+
+
+def merge_snapshots(snapshots):
+    '''
+    Adds up the counters and histograms of the snapshots
+    '''
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts, total in snapshot["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, [[0] * len(counts), 0.0])
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+    return counters, histograms
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Alive, run by another user
+        return True
+    return True
+
+
+def snapshot_pid(path):
+    return int(os.path.basename(path).split('-')[0])
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def write_json(directory, name, data):
+    '''
+    Replaces the file atomically, readers never see it half written. The
+    temporary file starts with the pid, so the one of a process killed
+    meanwhile can be removed.
+    '''
+    fd, path = tempfile.mkstemp(
+        dir=directory, prefix='{0}-'.format(os.getpid()), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(path, os.path.join(directory, name))
+
+
+class Counter():
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def inc(self, value=1, **labels):
+        self.registry.inc(self.name, labels_key(labels), value)
+
+
+class Histogram():
+    def __init__(self, registry, name, buckets):
+        self.registry = registry
+        self.name = name
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        self.registry.observe(self.name, labels_key(labels), value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+class Registry():
+    '''
+    Counters and histograms of the process, rendered in the Prometheus
+    text format. With a directory, a snapshot of the metrics is written
+    there at most every flush_interval seconds (and on every render) as
+    <pid>-<uuid>.json, and render adds up the snapshots of all the
+    processes. The snapshots of dead processes are added to merged.json,
+    so totals do not go back and a reused pid does not hide them.
+    '''
+    def __init__(self, directory=METRICS_DIR,
+                 flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.counters = {}
+        self.histograms = {}
+        self.flushed_at = time.monotonic()
+        self.pid = None
+        self.snapshot_name = None
+
+    def counter(self, name, documentation):
+        self.metrics[name] = ('counter', documentation, None)
+        return Counter(self, name)
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.metrics[name] = ('histogram', documentation, buckets)
+        return Histogram(self, name, buckets)
+
+    def inc(self, name, labels, value):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.maybe_flush()
+
+    def observe(self, name, labels, value):
+        buckets = self.metrics[name][2]
+        with self.lock:
+            key = (name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # Counts per bucket (the last one is +Inf), sum
+                histogram = [[0] * (len(buckets) + 1), 0.0]
+                self.histograms[key] = histogram
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+        self.maybe_flush()
+
+    def snapshot(self):
+        with self.lock:
+            return snapshot_of(self.counters, self.histograms)
+
+    def reset(self):
+        '''
+        Forgets the samples, a worker forked from a preloaded master does
+        not report the ones of the master again
+        '''
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.flushed_at = time.monotonic()
+
+    def maybe_flush(self):
+        if self.directory is None or \
+                time.monotonic() - self.flushed_at < self.flush_interval:
+            return
+        self.flush()
+
+    def flush(self):
+        '''
+        Writes the snapshot of the process atomically
+        '''
+        self.flushed_at = time.monotonic()
+        if self.pid != os.getpid():
+            # A forked process does not overwrite the file of its parent
+            self.pid = os.getpid()
+            self.snapshot_name = '{0}-{1}.json'.format(
+                self.pid, uuid.uuid4().hex)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_json(self.directory, self.snapshot_name, self.snapshot())
+        except Exception as e:
+            print("\nEXCEPTION metrics flush", e, end='\n\n')
+
+    def read_snapshots(self):
+        '''
+        Adds the snapshots of the dead processes to merged.json and removes
+        them. merged.json names them until the next merge, so a crash
+        before they are removed does not add them twice. Returns the
+        snapshots of the live processes and merged.json.
+        '''
+        mergedPath = os.path.join(self.directory, MERGED_SNAPSHOT)
+        merged = {"counters": [], "histograms": [], "names": []}
+        if os.path.exists(mergedPath):
+            with open(mergedPath) as f:
+                merged = json.load(f)
+        for name in merged["names"]:
+            remove_file(os.path.join(self.directory, name))
+        live = []
+        dead = {}
+        for path in glob.glob(os.path.join(self.directory, '*-*.json')):
+            try:
+                alive = process_alive(snapshot_pid(path))
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except Exception as e:
+                print("\nEXCEPTION metrics collect", e, end='\n\n')
+                continue
+            if alive:
+                live.append(snapshot)
+            else:
+                dead[os.path.basename(path)] = snapshot
+        if len(dead) > 0:
+            counters, histograms = merge_snapshots(
+                [merged] + list(dead.values()))
+            merged = snapshot_of(counters, histograms)
+            merged["names"] = list(dead)
+            write_json(self.directory, MERGED_SNAPSHOT, merged)
+            for name in dead:
+                remove_file(os.path.join(self.directory, name))
+        for path in glob.glob(os.path.join(self.directory, '*-*.tmp')):
+            # Left by a process killed while writing
+            if not process_alive(snapshot_pid(path)):
+                remove_file(path)
+        return live + [merged]
+
+    def collect(self):
+        '''
+        Returns the counters and histograms of all the processes
+        '''
+        if self.directory is None:
+            return merge_snapshots([self.snapshot()])
+        self.flush()
+        try:
+            with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+                # One process merges at a time, and the others do not read
+                # a dead snapshot after it has been merged
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                snapshots = self.read_snapshots()
+        except Exception as e:
+            print("\nEXCEPTION metrics collect", e, end='\n\n')
+            snapshots = [self.snapshot()]
+        return merge_snapshots(snapshots)
+
+    def render(self):
+        counters, histograms = self.collect()
+        lines = []
+        for name, (kind, documentation, buckets) in sorted(
+                self.metrics.items()):
+            lines.append('# HELP {0} {1}'.format(name, documentation))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append('{0}{1} {2}'.format(
+                            name, format_labels(labels), value))
+                continue
+            for (metric, labels), (counts, total) in sorted(
+                    histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                bounds = [str(bound) for bound in buckets] + ['+Inf']
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name,
+                        format_labels(labels + (('le', bound),)),
+                        cumulative))
+                lines.append('{0}_sum{1} {2}'.format(
+                    name, format_labels(labels), total))
+                lines.append('{0}_count{1} {2}'.format(
+                    name, format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+        )
+        for name, value in labels
+    ) + '}'
+
+
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.histogram(
+    'http_request_seconds',
+    'Duration of the requests by route, without the streamed bodies')
+HTTP_REQUEST_ERRORS = registry.counter(
+    'http_request_errors_total', 'Responses with an error status by route')
+DB_QUERY_SECONDS = registry.histogram(
+    'db_query_seconds', 'Duration of every SQL statement')
+DB_QUERIES_PER_REQUEST = registry.histogram(
+    'db_queries_per_request', 'SQL statements run by a request by route',
+    COUNT_BUCKETS)
+DB_SECONDS_PER_REQUEST = registry.histogram(
+    'db_seconds_per_request', 'Time a request spent in SQL by route')
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    DB_QUERY_SECONDS.observe(duration)
+    if has_request_context():
+        g.metrics_queries = g.get('metrics_queries', 0) + 1
+        g.metrics_query_seconds = g.get('metrics_query_seconds', 0) + duration
+
+
+def before_request():
+    g.metrics_start = time.perf_counter()
+
+
+def after_request(response):
+    start = g.get('metrics_start')
+    if start is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = {"method": request.method, "route": route}
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, **labels)
+    if response.status_code >= 400:
+        HTTP_REQUEST_ERRORS.inc(status=response.status_code, **labels)
+    DB_QUERIES_PER_REQUEST.observe(g.get('metrics_queries', 0), **labels)
+    DB_SECONDS_PER_REQUEST.observe(
+        g.get('metrics_query_seconds', 0), **labels)
+    return response
+
+
+def instrument(app):
+    '''
+    Records the duration and errors of the requests to the routes of app
+    and the SQL statements they run. Statements are timed in every
+    engine of the process, including the ones run outside of requests.
+    '''
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    app.before_request(before_request)
+    app.after_request(after_request)
@@ -0,0 +1,93 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from flask import Flask, abort
+from metrics import Registry, instrument, registry
+
+
+class RegistryTests(unittest.TestCase):
+    def testHistogramBucketsAreCumulative(self):
+        metrics = Registry(directory=None)
+        histogram = metrics.histogram('latency_seconds', 'Latency', (1, 2))
+        histogram.observe(0.5, route='/a')
+        histogram.observe(1.5, route='/a')
+        histogram.observe(3, route='/a')
+        text = metrics.render()
+        self.assertIn('latency_seconds_bucket{route="/a",le="1"} 1', text)
+        self.assertIn('latency_seconds_bucket{route="/a",le="2"} 2', text)
+        self.assertIn('latency_seconds_bucket{route="/a",le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_sum{route="/a"} 5.0', text)
+        self.assertIn('latency_seconds_count{route="/a"} 3', text)
+        self.assertIn('# TYPE latency_seconds histogram', text)
+
+    def testProcessesAreAddedUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics = Registry(directory=directory, flush_interval=60)
+        errors = metrics.counter('errors_total', 'Errors')
+        errors.inc(status=500)
+        # Snapshot left by another worker
+        write_errors(directory, '{0}-a.json'.format(os.getppid()), 2)
+        self.assertIn('errors_total{status="500"} 3', metrics.render())
+
+    def testDeadProcessesAreMerged(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics = Registry(directory=directory, flush_interval=60)
+        errors = metrics.counter('errors_total', 'Errors')
+        errors.inc(status=500)
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        write_errors(directory, '{0}-a.json'.format(process.pid), 2)
+        self.assertIn('errors_total{status="500"} 3', metrics.render())
+        self.assertEqual(
+            sorted(name for name in os.listdir(directory)
+                   if name.endswith('.json')),
+            sorted([metrics.snapshot_name, 'merged.json']))
+
+        # test the next dead process is added to the merged totals
+        write_errors(directory, '{0}-b.json'.format(process.pid), 4)
+        self.assertIn('errors_total{status="500"} 7', metrics.render())
+        self.assertIn('errors_total{status="500"} 7', metrics.render())
+
+
+def write_errors(directory, name, value):
+    with open(os.path.join(directory, name), 'w') as f:
+        f.write('{"counters": [["errors_total", [["status", 500]], %d]],'
+                ' "histograms": []}' % value)
+
+
+class InstrumentTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(setattr, registry, 'directory', registry.directory)
+        registry.directory = directory
+
+    def testRoutesAreRecorded(self):
+        app = Flask(__name__)
+        instrument(app)
+
+        @app.route('/items/<int:itemId>')
+        def get_item(itemId):
+            if itemId == 0:
+                abort(404)
+            return 'item'
+
+        client = app.test_client()
+        client.get('/items/1')
+        client.get('/items/0')
+        text = registry.render()
+        self.assertIn(
+            'http_request_seconds_count{method="GET",'
+            'route="/items/<int:itemId>"} 2', text)
+        self.assertIn(
+            'http_request_errors_total{method="GET",'
+            'route="/items/<int:itemId>",status="404"} 1', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
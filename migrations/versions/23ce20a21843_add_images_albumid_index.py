@@ -0,0 +1,36 @@
+"""Add (albumId, id) index to images.
+
+Revision ID: 23ce20a21843
+Revises: ba5341eaeaed
+Create Date: 2026-10-18 10:12:31.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '23ce20a21843'
+down_revision = 'ba5341eaeaed'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_images_albumId_id',
+            'images',
+            ['albumId', 'id'],
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_images_albumId_id',
+            table_name='images',
+            postgresql_concurrently=True
+        )
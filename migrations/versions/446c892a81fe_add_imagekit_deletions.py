@@ -0,0 +1,42 @@
+"""Add imagekit_deletions table.
+
+Revision ID: 446c892a81fe
+Revises: 8c9e7b0c21a6
+Create Date: 2026-10-18 13:05:44.902315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '446c892a81fe'
+down_revision = '8c9e7b0c21a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('imagekit_deletions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('imageKitId', sa.String(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('runAfter', sa.DateTime(), nullable=False),
+    sa.Column('createdAt', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        'ix_imagekit_deletions_status_runAfter',
+        'imagekit_deletions',
+        ['status', 'runAfter']
+    )
+
+
+def downgrade():
+    op.drop_index(
+        'ix_imagekit_deletions_status_runAfter',
+        table_name='imagekit_deletions'
+    )
+    op.drop_table('imagekit_deletions')
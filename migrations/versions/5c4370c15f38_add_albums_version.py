@@ -0,0 +1,27 @@
+"""Add version counter to albums.
+
+Revision ID: 5c4370c15f38
+Revises: 23ce20a21843
+Create Date: 2026-10-18 11:02:47.538201
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c4370c15f38'
+down_revision = '23ce20a21843'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'albums',
+        sa.Column('version', sa.Integer(), nullable=False, server_default='0')
+    )
+
+
+def downgrade():
+    op.drop_column('albums', 'version')
@@ -0,0 +1,57 @@
+"""Add contentHash to images and upload_jobs.
+
+Revision ID: 733e6ea39295
+Revises: 446c892a81fe
+Create Date: 2026-10-18 14:21:07.318452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '733e6ea39295'
+down_revision = '446c892a81fe'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('images', sa.Column(
+        'contentHash', sa.String(length=64), nullable=True))
+    op.add_column('upload_jobs', sa.Column(
+        'contentHash', sa.String(length=64), nullable=True))
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_images_albumId_contentHash',
+            'images',
+            ['albumId', 'contentHash'],
+            unique=True,
+            postgresql_concurrently=True
+        )
+        op.create_index(
+            'ix_images_contentHash',
+            'images',
+            ['contentHash'],
+            postgresql_concurrently=True
+        )
+        op.create_index(
+            'ix_images_imageKitId',
+            'images',
+            ['imageKitId'],
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for index in ['ix_images_imageKitId', 'ix_images_contentHash',
+                      'ix_images_albumId_contentHash']:
+            op.drop_index(
+                index,
+                table_name='images',
+                postgresql_concurrently=True
+            )
+    op.drop_column('upload_jobs', 'contentHash')
+    op.drop_column('images', 'contentHash')
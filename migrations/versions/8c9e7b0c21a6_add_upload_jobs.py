@@ -0,0 +1,45 @@
+"""Add upload_jobs table.
+
+Revision ID: 8c9e7b0c21a6
+Revises: 5c4370c15f38
+Create Date: 2026-10-18 12:20:09.671553
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c9e7b0c21a6'
+down_revision = '5c4370c15f38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('upload_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('albumId', sa.Integer(), nullable=True),
+    sa.Column('path', sa.String(), nullable=False),
+    sa.Column('fileName', sa.String(), nullable=True),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('imageId', sa.Integer(), nullable=True),
+    sa.Column('runAfter', sa.DateTime(), nullable=False),
+    sa.Column('createdAt', sa.DateTime(), nullable=False),
+    sa.Column('updatedAt', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['albumId'], ['albums.id'], ondelete='SET NULL'),
+    sa.ForeignKeyConstraint(['imageId'], ['images.id'], ondelete='SET NULL'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        'ix_upload_jobs_status_runAfter',
+        'upload_jobs',
+        ['status', 'runAfter']
+    )
+
+
+def downgrade():
+    op.drop_index('ix_upload_jobs_status_runAfter', table_name='upload_jobs')
+    op.drop_table('upload_jobs')
@@ -0,0 +1,25 @@
+"""Add perceptualHash to images.
+
+Revision ID: 9f1d2a7c4b3e
+Revises: 733e6ea39295
+Create Date: 2026-10-18 15:02:48.671930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9f1d2a7c4b3e'
+down_revision = '733e6ea39295'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('images', sa.Column(
+        'perceptualHash', sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('images', 'perceptualHash')
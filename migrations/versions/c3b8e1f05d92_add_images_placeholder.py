@@ -0,0 +1,25 @@
+"""Add placeholder to images.
+
+Revision ID: c3b8e1f05d92
+Revises: 9f1d2a7c4b3e
+Create Date: 2026-10-18 16:11:23.480156
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3b8e1f05d92'
+down_revision = '9f1d2a7c4b3e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('images', sa.Column(
+        'placeholder', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('images', 'placeholder')
@@ -1,5 +1,7 @@
 import os
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import aliased
 import json
 
 database_path = os.environ['DATABASE_URL']
@@ -8,6 +10,10 @@ if database_path.startswith("postgres://"):
 
 db = SQLAlchemy()
 
+# album: an image uploaded twice to the same album is stored once
+# global: images with the same content share the imagekit file
+DEDUP_SCOPE = os.environ.get('DEDUP_SCOPE', 'album')
+
 
 def setup_db(app):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
@@ -31,6 +37,9 @@ class Album(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
+    # Bumped by every change to the album or its images, used for ETags
+    version = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
 
     def insert(self):
         db.session.add(self)
@@ -43,11 +52,154 @@ class Album(db.Model):
     def update(self):
         db.session.commit()
 
+    def delete_cascade(self):
+        '''
+        Deletes the album and its images in a single transaction, the
+        imagekit files no other album references are queued in
+        imagekit_deletions for the worker
+        '''
+        self.delete_all([self.id])
+        db.session.commit()
+
+    @classmethod
+    def insert_names(cls, names):
+        '''
+        Inserts an album for every name with a single INSERT ... RETURNING
+        in the current transaction. Returns their data in the same order.
+        '''
+        rows = db.session.execute(
+            db.insert(cls).returning(
+                *cls.data_columns(), sort_by_parameter_order=True),
+            [{"name": name} for name in names]
+        )
+        return [cls.rowData(row) for row in rows]
+
+    @classmethod
+    def rename_all(cls, names):
+        '''
+        Renames the albums of names, albumId -> name, and bumps their
+        versions with a single UPDATE in the current transaction. Returns
+        (id, name, version) of the albums that exist.
+        '''
+        return db.session.execute(
+            db.update(cls)
+            .where(cls.id.in_(names))
+            .values(name=db.case(names, value=cls.id),
+                    version=cls.version + 1)
+            .returning(cls.id, cls.name, cls.version)
+            .execution_options(synchronize_session=False)
+        ).all()
+
+    @classmethod
+    def delete_all(cls, albumIds):
+        '''
+        delete_cascade of many albums in the current transaction. Returns
+        the ids of the albums that existed.
+        '''
+        other = aliased(Image)
+        deleteImages = db.delete(Image).where(Image.albumId.in_(albumIds))
+        if db.session.get_bind().dialect.name == 'postgresql':
+            # A single statement queues exactly the files of the images it
+            # deletes, an image added to the albums or copied from them
+            # meanwhile cannot slip between the queue and the delete
+            deleted = deleteImages.returning(Image.imageKitId).cte('deleted')
+            referencedElsewhere = db.exists().where(
+                other.imageKitId == deleted.c.imageKitId,
+                other.albumId.not_in(albumIds)
+            )
+            # The column defaults are not applied to an insert with a CTE
+            now = datetime.utcnow()
+            rows = db.select(
+                deleted.c.imageKitId,
+                db.literal(ImageKitDeletion.PENDING),
+                db.literal(0),
+                db.literal(now),
+                db.literal(now)
+            ).where(~referencedElsewhere).distinct()
+            db.session.execute(
+                db.insert(ImageKitDeletion)
+                .from_select([
+                    'imageKitId', 'status', 'attempts', 'runAfter',
+                    'createdAt'
+                ], rows)
+                .add_cte(deleted)
+            )
+        else:
+            # SQLite does not take a DELETE in a CTE, its writers are
+            # serialized anyway
+            referencedElsewhere = db.exists().where(
+                other.imageKitId == Image.imageKitId,
+                other.albumId.not_in(albumIds)
+            )
+            imageKitIds = db.select(Image.imageKitId).where(
+                Image.albumId.in_(albumIds),
+                ~referencedElsewhere
+            ).distinct()
+            db.session.execute(
+                db.insert(ImageKitDeletion)
+                .from_select(['imageKitId'], imageKitIds)
+            )
+            db.session.execute(deleteImages)
+        return db.session.execute(
+            db.delete(cls).where(cls.id.in_(albumIds)).returning(cls.id)
+        ).scalars().all()
+
+    @classmethod
+    def bump_version_statement(cls, albumId):
+        return db.update(cls) \
+            .where(cls.id == albumId) \
+            .values(version=cls.version + 1) \
+            .returning(cls.version)
+
+    @classmethod
+    def bump_version(cls, albumId):
+        '''
+        Increments the version in the current transaction, it is committed
+        with the change that motivated it. Returns the new version.
+        '''
+        return db.session.execute(cls.bump_version_statement(albumId)).scalar()
+
+    @classmethod
+    def bump_versions(cls, albumIds):
+        '''
+        bump_version of many albums with a single UPDATE. Returns the new
+        versions by albumId.
+        '''
+        return dict(db.session.execute(
+            db.update(cls)
+            .where(cls.id.in_(albumIds))
+            .values(version=cls.version + 1)
+            .returning(cls.id, cls.version)
+            .execution_options(synchronize_session=False)
+        ).all())
+
+    @classmethod
+    async def bump_version_async(cls, session, albumId):
+        '''
+        bump_version in the transaction of an AsyncSession
+        '''
+        result = await session.execute(cls.bump_version_statement(albumId))
+        return result.scalar()
+
+    # Keys of getData(), the listings build it from data_columns() rows
+    DATA_KEYS = ('id', 'name')
+
+    @classmethod
+    def data_columns(cls):
+        '''
+        Columns read by the listings, which skip the ORM
+        '''
+        return [getattr(cls, key) for key in cls.DATA_KEYS]
+
+    @classmethod
+    def rowData(cls, row):
+        '''
+        getData() of a row of data_columns()
+        '''
+        return dict(zip(cls.DATA_KEYS, row))
+
     def getData(self):
-        return {
-            "id": self.id,
-            "name": self.name
-        }
+        return {key: getattr(self, key) for key in self.DATA_KEYS}
 
     def __repr__(self):
         return f'<Venue name={self.name}>'
@@ -55,6 +207,13 @@ class Album(db.Model):
 
 class Image(db.Model):
     __tablename__ = 'images'
+    __table_args__ = (
+        db.Index('ix_images_albumId_id', 'albumId', 'id'),
+        db.Index('ix_images_albumId_contentHash',
+                 'albumId', 'contentHash', unique=True),
+        db.Index('ix_images_contentHash', 'contentHash'),
+        db.Index('ix_images_imageKitId', 'imageKitId'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     # name = db.Column(db.String, nullable = False)
@@ -64,6 +223,12 @@ class Image(db.Model):
     url = db.Column(db.String, nullable=False)
     imageKitId = db.Column(db.String, nullable=False)
     albumId = db.Column(db.Integer, db.ForeignKey('albums.id'))
+    # SHA-256 of the uploaded file, used to detect duplicates
+    contentHash = db.Column(db.String(64))
+    # 64 bit difference hash, used to find near-duplicates
+    perceptualHash = db.Column(db.BigInteger)
+    # Tiny base64 image shown until the image is loaded
+    placeholder = db.Column(db.String)
 
     def insert(self):
         db.session.add(self)
@@ -76,14 +241,264 @@ class Image(db.Model):
     def update(self):
         db.session.commit()
 
+    @classmethod
+    def fromUpload(cls, upload, albumId, contentHash=None):
+        '''
+        Builds the image of a successful ImageControl.upload_file, with
+        the content hash it computed unless the caller had one
+        '''
+        return cls(
+            w=upload['width'],
+            h=upload['height'],
+            url=upload['metadata']['url'],
+            imageKitId=upload['metadata']['fileId'],
+            albumId=albumId,
+            contentHash=contentHash or upload.get('contentHash'),
+            perceptualHash=upload.get('perceptualHash'),
+            placeholder=upload.get('placeholder')
+        )
+
+    @classmethod
+    def find_duplicate(cls, contentHash, albumId):
+        '''
+        Looks for an image with the same content. An image of the album
+        is returned as it is. With the global DEDUP_SCOPE an image of
+        another album is copied into this one, sharing its imagekit file,
+        and returned without being inserted. None if there is no
+        duplicate.
+        '''
+        image = db.session.execute(
+            cls.same_content_statement(contentHash, albumId)).scalar()
+        if image is not None or DEDUP_SCOPE != 'global':
+            return image
+        original = db.session.execute(
+            cls.same_content_statement(contentHash)).scalar()
+        return cls.copy_of(original, albumId)
+
+    @classmethod
+    async def find_duplicate_async(cls, session, contentHash, albumId):
+        '''
+        find_duplicate in the transaction of an AsyncSession
+        '''
+        image = (await session.execute(
+            cls.same_content_statement(contentHash, albumId))).scalar()
+        if image is not None or DEDUP_SCOPE != 'global':
+            return image
+        original = (await session.execute(
+            cls.same_content_statement(contentHash))).scalar()
+        return cls.copy_of(original, albumId)
+
+    @classmethod
+    def same_content_statement(cls, contentHash, albumId=None):
+        '''
+        An image with the content in the album, or in any album if it is
+        None. The latter is locked so the file can not be deleted before
+        a copy of it is saved.
+        '''
+        statement = db.select(cls).where(cls.contentHash == contentHash)
+        if albumId is not None:
+            return statement.where(cls.albumId == albumId).limit(1)
+        return statement.limit(1).with_for_update()
+
+    @classmethod
+    def copy_of(cls, original, albumId):
+        '''
+        New image of the album sharing the imagekit file of original
+        '''
+        if original is None:
+            return None
+        return cls(
+            w=original.w,
+            h=original.h,
+            url=original.url,
+            imageKitId=original.imageKitId,
+            albumId=albumId,
+            contentHash=original.contentHash,
+            perceptualHash=original.perceptualHash,
+            placeholder=original.placeholder
+        )
+
+    @classmethod
+    def count_references(cls, imageKitId):
+        '''
+        Number of images using the imagekit file, their rows stay locked
+        until the end of the transaction
+        '''
+        return len(db.session.execute(
+            cls.references_statement(imageKitId)).all())
+
+    @classmethod
+    def sharing_files(cls, imageIds):
+        '''
+        (id, imageKitId, albumId) of the images and of every image that
+        shares an imagekit file with them, read with a single query. The
+        rows stay locked until the end of the transaction.
+        '''
+        imageKitIds = db.select(cls.imageKitId).where(cls.id.in_(imageIds))
+        return db.session.execute(
+            db.select(cls.id, cls.imageKitId, cls.albumId)
+            .where(cls.imageKitId.in_(imageKitIds))
+            .with_for_update()
+        ).all()
+
+    @classmethod
+    def delete_all(cls, imageIds):
+        db.session.execute(db.delete(cls).where(cls.id.in_(imageIds)))
+
+    @classmethod
+    async def count_references_async(cls, session, imageKitId):
+        result = await session.execute(cls.references_statement(imageKitId))
+        return len(result.all())
+
+    @classmethod
+    def references_statement(cls, imageKitId):
+        ids = db.select(cls.id).where(cls.imageKitId == imageKitId)
+        return ids.with_for_update()
+
+    @classmethod
+    def perceptual_hashes(cls, albumId):
+        '''
+        (id, perceptualHash) of the images of the album that have one
+        '''
+        return db.session.execute(
+            cls.perceptual_hashes_statement(albumId)).all()
+
+    @classmethod
+    async def perceptual_hashes_async(cls, session, albumId):
+        result = await session.execute(
+            cls.perceptual_hashes_statement(albumId))
+        return result.all()
+
+    @classmethod
+    def perceptual_hashes_statement(cls, albumId):
+        return db.select(cls.id, cls.perceptualHash).where(
+            cls.albumId == albumId,
+            cls.perceptualHash.isnot(None)
+        )
+
+    @classmethod
+    def first_per_album(cls, albumIds, limit):
+        '''
+        Returns the data_columns() rows of the first limit images of every
+        album ordered by album and id, with a single query. The window is
+        numbered along the (albumId, id) index.
+        '''
+        position = db.func.row_number().over(
+            partition_by=cls.albumId,
+            order_by=cls.id
+        ).label('position')
+        ranked = db.select(*cls.data_columns(), position).where(
+            cls.albumId.in_(albumIds)).subquery()
+        columns = [ranked.c[column.key] for column in cls.data_columns()]
+        return db.session.connection().execute(
+            db.select(*columns)
+            .where(ranked.c.position <= limit)
+            .order_by(ranked.c.albumId, ranked.c.id)
+        ).all()
+
+    @staticmethod
+    def insert_all(images):
+        db.session.add_all(images)
+        db.session.commit()
+
+    # Keys of getData(), the listings build it from data_columns() rows
+    DATA_KEYS = ('id', 'w', 'h', 'url', 'albumId', 'placeholder')
+
+    @classmethod
+    def data_columns(cls):
+        '''
+        Columns read by the listings, which skip the ORM. imageKitId goes
+        after DATA_KEYS, it is not sent but is needed to build srcsets.
+        '''
+        return [getattr(cls, key) for key in cls.DATA_KEYS] + \
+            [cls.imageKitId]
+
+    @classmethod
+    def rowData(cls, row):
+        '''
+        getData() of a row of data_columns()
+        '''
+        return dict(zip(cls.DATA_KEYS, row))
+
+    def getData(self):
+        return {key: getattr(self, key) for key in self.DATA_KEYS}
+
+    def __repr__(self):
+        return f'<Artist url={self.url}>'
+
+
+class UploadJob(db.Model):
+    __tablename__ = 'upload_jobs'
+    __table_args__ = (
+        db.Index('ix_upload_jobs_status_runAfter', 'status', 'runAfter'),
+    )
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    albumId = db.Column(
+        db.Integer, db.ForeignKey('albums.id', ondelete='SET NULL'))
+    # Spooled file in the local disk, removed when the job finishes
+    path = db.Column(db.String, nullable=False)
+    fileName = db.Column(db.String)
+    status = db.Column(db.String, nullable=False, default=PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String)
+    contentHash = db.Column(db.String(64))
+    imageId = db.Column(
+        db.Integer, db.ForeignKey('images.id', ondelete='SET NULL'))
+    runAfter = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    createdAt = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow)
+    updatedAt = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def update(self):
+        self.updatedAt = datetime.utcnow()
+        db.session.commit()
+
     def getData(self):
         return {
             "id": self.id,
-            "w": self.w,
-            "h": self.h,
-            "url": self.url,
             "albumId": self.albumId,
+            "fileName": self.fileName,
+            "status": self.status,
+            "attempts": self.attempts,
+            "error": self.error,
+            "imageId": self.imageId,
+            "createdAt": self.createdAt.isoformat(),
+            "updatedAt": self.updatedAt.isoformat(),
         }
 
     def __repr__(self):
-        return f'<Artist url={self.url}>'
+        return f'<UploadJob id={self.id} status={self.status}>'
+
+
+class ImageKitDeletion(db.Model):
+    __tablename__ = 'imagekit_deletions'
+    __table_args__ = (
+        db.Index('ix_imagekit_deletions_status_runAfter',
+                 'status', 'runAfter'),
+    )
+
+    PENDING = 'pending'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    imageKitId = db.Column(db.String, nullable=False)
+    status = db.Column(db.String, nullable=False, default=PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String)
+    runAfter = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    createdAt = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ImageKitDeletion imageKitId={self.imageKitId}>'
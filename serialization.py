@@ -0,0 +1,46 @@
+import json
+from flask import Response, stream_with_context
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(data):
+    '''
+    Encodes data as compact JSON bytes with sorted keys, the same layout
+    as jsonify. orjson is used when it is installed.
+    '''
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(data, separators=(',', ':'), sort_keys=True).encode()
+
+
+def json_response(data, status=200):
+    return Response(dumps(data), status=status, mimetype='application/json')
+
+
+def stream_json_response(data, key, chunks):
+    '''
+    Streams data with the list in key built from chunks, a generator of
+    lists of items. Every chunk is encoded with a single dumps call and
+    sent as soon as it is ready, so the memory used does not depend on
+    the length of the list. The body is the same json_response would
+    send for data with the whole list in key.
+    '''
+    before = dumps({k: v for k, v in data.items() if k < key})[1:-1]
+    after = dumps({k: v for k, v in data.items() if k > key})[1:-1]
+
+    def generate():
+        yield b'{' + (before + b',' if before else b'') + dumps(key) + b':['
+        separator = b''
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            yield separator + dumps(chunk)[1:-1]
+            separator = b','
+        yield b']' + (b',' + after if after else b'') + b'}'
+
+    return Response(
+        stream_with_context(generate()), mimetype='application/json')
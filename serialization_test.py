@@ -0,0 +1,44 @@
+import json
+import unittest
+from flask import Flask
+import serialization
+from serialization import dumps, json_response, stream_json_response
+
+
+class SerializationTests(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.data = {
+            "success": True,
+            "images": [{"id": i, "w": 1, "url": "u"} for i in range(5)],
+            "next_cursor": None,
+        }
+
+    def testDumpsSortsKeysCompactly(self):
+        expected = json.dumps(
+            self.data, separators=(',', ':'), sort_keys=True).encode()
+        self.assertEqual(dumps(self.data), expected)
+
+    def testStdlibFallback(self):
+        encoded = dumps(self.data)
+        module_orjson = serialization.orjson
+        serialization.orjson = None
+        try:
+            self.assertEqual(dumps(self.data), encoded)
+        finally:
+            serialization.orjson = module_orjson
+
+    def testStreamedBodyIsTheSame(self):
+        images = self.data["images"]
+        data = {"success": True, "next_cursor": None}
+        for chunks in [[images[:2], [], images[2:]], [], [[]]]:
+            with self.app.test_request_context():
+                response = stream_json_response(data, "images", iter(chunks))
+                body = b''.join(response.response)
+                expected = dict(data, images=sum(chunks, []))
+                self.assertEqual(body, json_response(expected).get_data())
+                self.assertTrue(response.is_streamed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+import functools
+import threading
+from cache import LRUCache
+
+# numpy is imported by the functions that use it, so importing the app
+# does not load it until the first near-duplicate search
+
+
+@functools.lru_cache(maxsize=None)
+def popcount_table():
+    '''
+    Number of bits set in every 16 bit word (64KB, fits in the L2 cache),
+    numpy < 2 has no bitwise_count
+    '''
+    import numpy as np
+    return np.array(
+        [bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8)
+
+
+def hamming_distances(hashes, perceptualHash):
+    '''
+    Hamming distance between every 64 bit hash of the array and the
+    given one, computed with a vectorized XOR and popcount
+    '''
+    import numpy as np
+    xor = np.bitwise_xor(hashes, np.int64(perceptualHash))
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xor)
+    words = popcount_table()[xor.view(np.uint16)].reshape(-1, 4)
+    return words[:, 0] + words[:, 1] + words[:, 2] + words[:, 3]
+
+
+class AlbumIndex():
+    '''
+    Perceptual hashes of the images of an album in contiguous arrays.
+    Inserts are amortized by doubling the capacity and deletes move the
+    last image to the freed position, so updates do not copy the arrays.
+    version is the album version the index corresponds to.
+    '''
+    def __init__(self, rows, version):
+        import numpy as np
+        rows = np.array(rows, dtype=np.int64).reshape(-1, 2)
+        self.size = len(rows)
+        capacity = max(self.size, 16)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.hashes = np.zeros(capacity, dtype=np.int64)
+        self.ids[:self.size] = rows[:, 0]
+        self.hashes[:self.size] = rows[:, 1]
+        self.positions = {
+            int(imageId): position
+            for position, imageId in enumerate(rows[:, 0])
+        }
+        self.version = version
+        self.lock = threading.Lock()
+
+    def add(self, imageId, perceptualHash):
+        if imageId in self.positions:
+            return
+        if self.size == len(self.ids):
+            import numpy as np
+            self.ids = np.concatenate([self.ids, np.zeros_like(self.ids)])
+            self.hashes = np.concatenate(
+                [self.hashes, np.zeros_like(self.hashes)])
+        self.ids[self.size] = imageId
+        self.hashes[self.size] = perceptualHash
+        self.positions[imageId] = self.size
+        self.size += 1
+
+    def remove(self, imageId):
+        position = self.positions.pop(imageId, None)
+        if position is None:
+            return
+        self.size -= 1
+        if position != self.size:
+            lastId = int(self.ids[self.size])
+            self.ids[position] = lastId
+            self.hashes[position] = self.hashes[self.size]
+            self.positions[lastId] = position
+
+    def get_hash(self, imageId):
+        with self.lock:
+            position = self.positions.get(imageId)
+            return None if position is None else int(self.hashes[position])
+
+    def search(self, perceptualHash, max_distance, limit, exclude=None):
+        '''
+        Returns up to limit (imageId, distance) pairs within max_distance,
+        the closest first
+        '''
+        import numpy as np
+        with self.lock:
+            hashes = self.hashes[:self.size]
+            distances = hamming_distances(hashes, perceptualHash)
+            matches = np.flatnonzero(distances <= max_distance)
+            if exclude is not None and exclude in self.positions:
+                matches = matches[matches != self.positions[exclude]]
+            ids = self.ids[matches]
+        # Sorts only the candidates, not the whole album
+        order = np.lexsort((ids, distances[matches]))[:limit]
+        return [
+            (int(imageId), int(distance))
+            for imageId, distance in zip(ids[order], distances[matches][order])
+        ]
+
+    def __len__(self):
+        return self.size
+
+
+class SimilarityIndex():
+    '''
+    LRU of album indexes. Indexes are loaded from the database on first
+    use and reloaded when the album version changed in another worker;
+    the changes made through this worker are applied incrementally.
+    '''
+    def __init__(self, max_albums):
+        self.albums = LRUCache(max_albums)
+        self.lock = threading.Lock()
+
+    def get(self, albumId, version, load):
+        '''
+        Returns the index of the album at version, load returns the
+        (imageId, perceptualHash) rows of the album
+        '''
+        index = self.peek(albumId, version)
+        if index is not None:
+            return index
+        with self.lock:
+            index = self.peek(albumId, version)
+            if index is None:
+                index = self.put(albumId, version, load())
+            return index
+
+    def peek(self, albumId, version):
+        '''
+        The index of the album if it is loaded at version, None otherwise.
+        The ASGI app loads the rows itself and puts them.
+        '''
+        index = self.albums.get(albumId)
+        if index is not None and index.version == version:
+            return index
+        return None
+
+    def put(self, albumId, version, rows):
+        index = AlbumIndex(rows, version)
+        self.albums.set(albumId, index)
+        return index
+
+    def update(self, albumId, version, added=(), removed=()):
+        '''
+        Applies a change that moved the album to version. If the index is
+        not at the previous version the change can not be applied, and
+        the index is dropped to be reloaded on next use.
+        '''
+        index = self.albums.get(albumId)
+        if index is None:
+            return
+        with index.lock:
+            if index.version != version - 1:
+                self.albums.delete(albumId)
+                return
+            for imageId, perceptualHash in added:
+                if perceptualHash is not None:
+                    index.add(imageId, perceptualHash)
+            for imageId in removed:
+                index.remove(imageId)
+            index.version = version
+
+    def drop(self, albumId):
+        self.albums.delete(albumId)
+
+    def stats(self):
+        return self.albums.stats()
@@ -0,0 +1,77 @@
+import unittest
+import numpy as np
+from similarity import AlbumIndex, SimilarityIndex, hamming_distances
+
+
+class HammingDistancesTests(unittest.TestCase):
+    def testMatchesBinCount(self):
+        rng = np.random.default_rng(0)
+        hashes = rng.integers(-2 ** 63, 2 ** 63 - 1, 1000, dtype=np.int64)
+        query = int(hashes[0])
+        expected = [bin((int(h) ^ query) & (2 ** 64 - 1)).count('1')
+                    for h in hashes]
+        distances = hamming_distances(hashes, query)
+        self.assertEqual(distances.tolist(), expected)
+
+
+class AlbumIndexTests(unittest.TestCase):
+    def testSearchReturnsClosestFirst(self):
+        index = AlbumIndex([(1, 0b0000), (2, 0b0111), (3, 0b0001)], 0)
+        self.assertEqual(index.search(0, 3, 10), [(1, 0), (3, 1), (2, 3)])
+        self.assertEqual(index.search(0, 1, 10, exclude=1), [(3, 1)])
+        self.assertEqual(index.search(0, 64, 1), [(1, 0)])
+
+    def testNegativeHashes(self):
+        index = AlbumIndex([(1, -1), (2, 2 ** 63 - 1)], 0)
+        self.assertEqual(index.search(-1, 64, 10), [(1, 0), (2, 1)])
+
+    def testAddAndRemove(self):
+        index = AlbumIndex([], 0)
+        for imageId in range(100):
+            index.add(imageId, imageId)
+        self.assertEqual(len(index), 100)
+        index.remove(0)
+        index.remove(50)
+        index.remove(1000)
+        self.assertEqual(len(index), 98)
+        self.assertEqual(index.get_hash(50), None)
+        self.assertEqual(index.get_hash(99), 99)
+        self.assertEqual(index.search(50, 0, 10), [])
+        self.assertEqual(index.search(99, 0, 10), [(99, 0)])
+
+
+class SimilarityIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.loads = 0
+        self.rows = [(1, 0), (2, 1)]
+
+    def load(self):
+        self.loads += 1
+        return self.rows
+
+    def testIndexIsLoadedOncePerVersion(self):
+        similarity = SimilarityIndex(8)
+        similarity.get(1, 0, self.load)
+        similarity.get(1, 0, self.load)
+        self.assertEqual(self.loads, 1)
+        similarity.get(1, 1, self.load)
+        self.assertEqual(self.loads, 2)
+
+    def testUpdatesAreIncremental(self):
+        similarity = SimilarityIndex(8)
+        similarity.get(1, 0, self.load)
+        similarity.update(1, 1, added=[(3, 3)], removed=[1])
+        index = similarity.get(1, 1, self.load)
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(index.search(0, 64, 10), [(2, 1), (3, 2)])
+
+    def testMissedUpdateDropsIndex(self):
+        similarity = SimilarityIndex(8)
+        similarity.get(1, 0, self.load)
+        similarity.update(1, 2, added=[(3, 3)])
+        similarity.get(1, 2, self.load)
+        self.assertEqual(self.loads, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -29,6 +29,9 @@ class BaseList {
     const elInput = document.createElement('input')
     elInput.setAttribute('type', oParams.inputType)
     elInput.setAttribute('name', oParams.inputName)
+    if (oParams.multiple) {
+      elInput.setAttribute('multiple', '')
+    }
     elForm.appendChild(elInput)
 
     const elbutton = document.createElement('button')
@@ -42,7 +45,7 @@ class BaseList {
     elbutton.addEventListener('click', async (evt) => {
       evt.preventDefault()
       const oFormData = this.inputHandler(elInput)
-      this.fetch('POST', oParams.checkpoint, oFormData, (oResponse) => { this.addItemsToList(oResponse) })
+      this.fetch('POST', oParams.postCheckpoint || oParams.checkpoint, oFormData, (oResponse) => { this.addItemsToList(oResponse) })
     })
   }
 
@@ -100,8 +103,29 @@ class BaseList {
     elList.id = this.getListId()
     elListDiv.appendChild(elList)
 
-    return this.fetch('GET', oParams.checkpoint, null, (oResponse) => {
+    if (oParams.prefetched) {
+      // Received with the albums, only the rest of the list is fetched
+      this.addItemsToList(oParams.prefetched)
+      if (oParams.prefetched.next_cursor) {
+        this.fetchList(oParams.prefetched.next_cursor)
+      }
+      return
+    }
+    return this.fetchList()
+  }
+
+  fetchList (nAfter) {
+    const oQuery = new URLSearchParams(this.oParams.listQuery || {})
+    if (nAfter) {
+      oQuery.set('after', nAfter)
+    }
+    const sQuery = oQuery.toString()
+    const sCheckpoint = this.oParams.checkpoint + (sQuery ? '?' + sQuery : '')
+    return this.fetch('GET', sCheckpoint, null, (oResponse) => {
       this.addItemsToList(oResponse)
+      if (oResponse.next_cursor) {
+        this.fetchList(oResponse.next_cursor)
+      }
     })
   }
 
@@ -128,26 +152,31 @@ class BaseList {
 }
 
 class ImagesList extends BaseList {
-  constructor (oViewModel, elParent) {
+  constructor (oViewModel, elParent, oPrefetched) {
     const oParams = {
       mainDivId: definitions.id.IMAGES_LIST_MAIN_DIV + elParent.id,
       buttonText: definitions.messages.UPLOAD_IMAGE_BUTTON_TEXT,
       inputType: 'file',
-      inputName: 'file',
+      inputName: 'files',
+      multiple: true,
       postPermission: definitions.permissions.POST_IMAGES,
       deletePermission: definitions.permissions.DELETE_IMAGES,
       checkpoint: definitions.checkpoints.ALBUMS + '/' + elParent.id + definitions.checkpoints.IMAGES,
+      listQuery: { srcset: 'true' },
+      postCheckpoint: definitions.checkpoints.ALBUMS + '/' + elParent.id + definitions.checkpoints.IMAGES + definitions.checkpoints.BATCH,
       deleteCheckpoint: definitions.checkpoints.IMAGES,
       emptyListMessage: definitions.messages.NO_IMAGES_MESSAGE,
-      headerListMessage: definitions.messages.IMAGES_LIST_HEADER
+      headerListMessage: definitions.messages.IMAGES_LIST_HEADER,
+      prefetched: oPrefetched
     }
     super(oViewModel, oParams, elParent)
   }
 
   inputHandler (elInput) {
-    const oFile = elInput.files[0]
     const oFormData = new FormData()
-    oFormData.append('file', oFile)
+    for (let i = 0; i < elInput.files.length; i++) {
+      oFormData.append('files', elInput.files[i])
+    }
     return oFormData
   }
 
@@ -156,6 +185,11 @@ class ImagesList extends BaseList {
     const elList = document.getElementById(this.getListId())
     for (let i = 0; i < aImages.length; i++) {
       const oImage = aImages[i]
+      // A batch also answers with the images already in the album for its
+      // duplicate files, they have a tile
+      if (elList.querySelector(':scope > li[databaseId="' + oImage.id + '"]')) {
+        continue
+      }
       const nMax = oImage.w > oImage.h ? oImage.w : oImage.h
       const nHeight = oImage.h * definitions.images.MAX_SIDE / nMax
       const nWidth = oImage.w * definitions.images.MAX_SIDE / nMax
@@ -168,7 +202,17 @@ class ImagesList extends BaseList {
       elList.appendChild(elItem)
 
       const elImage = document.createElement('img')
+      if (oImage.placeholder) {
+        // Painted below the image until it is loaded
+        elImage.style.backgroundImage = 'url(' + oImage.placeholder + ')'
+        elImage.style.backgroundSize = '100% 100%'
+      }
       elImage.setAttribute('src', oImage.url)
+      if (oImage.srcset) {
+        // Lets the browser download the smallest copy that fills the tile
+        elImage.setAttribute('srcset', oImage.srcset)
+        elImage.setAttribute('sizes', nWidth + 'px')
+      }
       elImage.setAttribute('height', nHeight + 'px')
       elImage.setAttribute('width', nWidth + 'px')
       elItem.appendChild(elImage)
@@ -191,6 +235,12 @@ class AlbumsList extends BaseList {
       deletePermission: definitions.permissions.DELETE_ALBUMS,
       patchPermission: definitions.permissions.PATCH_ALBUM,
       checkpoint: definitions.checkpoints.ALBUMS,
+      // The first images of every album come in the same request
+      listQuery: {
+        include: 'images',
+        images_per_album: definitions.images.PER_ALBUM,
+        srcset: 'true'
+      },
       deleteCheckpoint: definitions.checkpoints.ALBUMS,
       emptyListMessage: definitions.messages.NO_ALBUMS_FOUND,
       headerListMessage: definitions.messages.ALBUMS_LIST_HEADER
@@ -211,7 +261,12 @@ class AlbumsList extends BaseList {
     if (elLastChild.id.includes(definitions.id.IMAGES_LIST_MAIN_DIV)) {
       elLastChild.remove()
     } else {
-      new ImagesList(this.oViewModel, elItem)
+      // Prefetched images are used once, reopening the album reloads them
+      const oPrefetched = this.oAlbumImages && this.oAlbumImages[elItem.id]
+      if (oPrefetched) {
+        delete this.oAlbumImages[elItem.id]
+      }
+      new ImagesList(this.oViewModel, elItem, oPrefetched)
     }
   }
 
@@ -270,8 +325,15 @@ class AlbumsList extends BaseList {
   addItemsToList (oData) {
     const aAlbums = oData.albums
     const elList = document.getElementById(this.getListId())
+    this.oAlbumImages = this.oAlbumImages || {}
     for (let i = 0; i < aAlbums.length; i++) {
       const oAlbum = aAlbums[i]
+      if (oAlbum.images) {
+        this.oAlbumImages[oAlbum.id] = {
+          images: oAlbum.images,
+          next_cursor: oAlbum.next_cursor
+        }
+      }
 
       const elAlbum = document.createElement('li')
       elAlbum.setAttribute('databaseId', oAlbum.id)
@@ -10,14 +10,15 @@ definitions.permissions = {
 
 definitions.checkpoints = {
   ALBUMS: '/albums',
-  IMAGES: '/images'
+  IMAGES: '/images',
+  BATCH: '/batch'
 }
 
 definitions.messages = {
   NO_IMAGES_MESSAGE: 'No images found',
   NO_ALBUMS_FOUND: 'No albums found.',
   CREATE_ALBUM_BUTTON_TEXT: 'Create Album',
-  UPLOAD_IMAGE_BUTTON_TEXT: 'Upload Image',
+  UPLOAD_IMAGE_BUTTON_TEXT: 'Upload Images',
   ALBUMS_LIST_HEADER: 'Albums available:',
   IMAGES_LIST_HEADER: ''
 }
@@ -41,5 +42,6 @@ definitions.attributes = {
 }
 
 definitions.images = {
-  MAX_SIDE: 200
+  MAX_SIDE: 200,
+  PER_ALBUM: 20
 }
@@ -0,0 +1,216 @@
+import abc
+import asyncio
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+from flask import Response, abort, send_from_directory
+
+# Directory of the filesystem backend, the uploads are written to a
+# temporary directory inside it so they are moved atomically
+STORAGE_DIR = os.environ.get('STORAGE_DIR', 'media')
+# Prefix of the urls of the files, /media is served by the app
+STORAGE_BASE_URL = os.environ.get('STORAGE_BASE_URL', '/media').rstrip('/')
+# Internal nginx location aliased to STORAGE_DIR. When it is set the app
+# only answers with X-Accel-Redirect and nginx sends the file.
+STORAGE_ACCEL_REDIRECT = os.environ.get('STORAGE_ACCEL_REDIRECT', None)
+# Files never change, their name is the hash of their content
+STORAGE_MAX_AGE = int(os.environ.get('STORAGE_MAX_AGE', 365 * 24 * 3600))
+COPY_CHUNK_SIZE = 1024 * 1024
+
+FILE_ID_PATTERN = re.compile(r'^[0-9a-f]{64}(\.[a-z0-9]{1,5})?$')
+# Python < 3.11 does not know it
+mimetypes.add_type('image/webp', '.webp')
+
+
+class Storage(abc.ABC):
+    '''
+    Where the images are stored. Responses are dictionaries with success,
+    the same ones ImageControl returned for imagekit:
+
+    * upload(file, image_name): metadata with fileId, url, width, height
+    * delete(fileId)
+    * bulk_delete(fileIds): deleted with the ids that are not stored
+      anymore, including the ones that were already missing
+    * url(fileId, url, width): url of the file resized to width (the
+      original for None) and when it expires, None if it does not
+    * thumbnail_url(url, size): url of a copy about size pixels long in
+      its longest edge, the original if it does not resize
+
+    resizes tells if url honours width, serves_files if send(fileId)
+    sends the files through the app. stats are the counters of the
+    connection to the storage.
+
+    The ASGI app awaits upload_async and delete_async, which run the
+    blocking versions in a thread unless the storage has native ones.
+    Their clients are created in open_async and closed in close_async,
+    in the event loop of the app.
+    '''
+    resizes = False
+    serves_files = False
+
+    @abc.abstractmethod
+    def upload(self, file, image_name):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, fileId):
+        pass
+
+    @abc.abstractmethod
+    def bulk_delete(self, fileIds):
+        pass
+
+    async def upload_async(self, file, image_name):
+        return await asyncio.to_thread(self.upload, file, image_name)
+
+    async def delete_async(self, fileId):
+        return await asyncio.to_thread(self.delete, fileId)
+
+    async def open_async(self):
+        pass
+
+    async def close_async(self):
+        pass
+
+    @abc.abstractmethod
+    def url(self, fileId, url, width=None):
+        pass
+
+    @abc.abstractmethod
+    def thumbnail_url(self, url, size):
+        pass
+
+    def send(self, fileId):
+        abort(404)
+
+    def stats(self):
+        return {}
+
+
+class FileSystemStorage(Storage):
+    '''
+    Stores the files in directory, named by the SHA-256 of their content
+    and sharded by its first bytes. The same content is stored once, the
+    callers count the references before deleting it. Files are served by
+    send with sendfile, or by nginx with accel_redirect.
+    '''
+    serves_files = True
+
+    def __init__(self, directory=STORAGE_DIR, base_url=STORAGE_BASE_URL,
+                 accel_redirect=STORAGE_ACCEL_REDIRECT):
+        self.directory = os.path.abspath(directory)
+        self.temporary_directory = os.path.join(self.directory, 'tmp')
+        self.base_url = base_url
+        self.accel_redirect = accel_redirect
+        os.makedirs(self.temporary_directory, exist_ok=True)
+
+    def relative_path(self, fileId):
+        return os.path.join(fileId[:2], fileId[2:4], fileId)
+
+    def path(self, fileId):
+        return os.path.join(self.directory, self.relative_path(fileId))
+
+    def upload(self, file, image_name):
+        '''
+        Copies file to a temporary file while hashing it, and renames it
+        to its final path, so readers never see a partial file. If the
+        content was already stored the rename replaces it with the same
+        bytes.
+        '''
+        from PIL import Image as PILImage
+        temporary = None
+        try:
+            extension = os.path.splitext(image_name)[1].lower()
+            digest = hashlib.sha256()
+            temporary = tempfile.NamedTemporaryFile(
+                dir=self.temporary_directory, delete=False)
+            with temporary:
+                for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    temporary.write(chunk)
+                temporary.flush()
+                os.fsync(temporary.fileno())
+            fileId = digest.hexdigest() + extension
+            if not FILE_ID_PATTERN.match(fileId):
+                raise Exception("Invalid file extension " + extension)
+            with PILImage.open(temporary.name) as image:
+                width, height = image.size
+            path = self.path(fileId)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temporary.name, path)
+            return {
+                "success": True,
+                "metadata": {
+                    "fileId": fileId,
+                    "name": image_name,
+                    "url": self.base_url + '/' + fileId,
+                    "width": width,
+                    "height": height,
+                    "size": os.path.getsize(path),
+                },
+            }
+        except Exception as e:
+            print("\nSTORAGE_EXCEPTION:", e, end='\n\n')
+            return {
+                "success": False,
+                "message": e,
+            }
+        finally:
+            if temporary is not None and os.path.exists(temporary.name):
+                os.remove(temporary.name)
+
+    def delete(self, fileId):
+        try:
+            if not FILE_ID_PATTERN.match(fileId):
+                raise Exception("Invalid file id " + fileId)
+            os.remove(self.path(fileId))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("\nSTORAGE_EXCEPTION:", e, end='\n\n')
+            return {
+                "success": False,
+                "message": e,
+            }
+        return {"success": True}
+
+    def bulk_delete(self, fileIds):
+        deleted = [
+            fileId for fileId in fileIds if self.delete(fileId)['success']
+        ]
+        return {
+            "success": len(deleted) == len(fileIds),
+            "deleted": deleted,
+            "message": None,
+        }
+
+    def url(self, fileId, url, width=None):
+        return url, None
+
+    def thumbnail_url(self, url, size):
+        return url
+
+    def send(self, fileId):
+        '''
+        Sends the file without reading it in Python: werkzeug hands it to
+        the wsgi.file_wrapper of the server (sendfile in gunicorn) and
+        answers Range and conditional requests. With accel_redirect the
+        body is left to nginx.
+        '''
+        if not FILE_ID_PATTERN.match(fileId):
+            abort(404)
+        relative = self.relative_path(fileId)
+        if self.accel_redirect is not None:
+            response = Response(mimetype=mimetypes.guess_type(fileId)[0] or
+                                'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = \
+                self.accel_redirect.rstrip('/') + '/' + relative
+        else:
+            response = send_from_directory(
+                self.directory, relative, max_age=STORAGE_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.max_age = STORAGE_MAX_AGE
+        response.cache_control.immutable = True
+        return response
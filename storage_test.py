@@ -0,0 +1,90 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from flask import Flask
+from PIL import Image as PILImage
+from storage import FileSystemStorage, Storage
+
+
+def sample_image():
+    output = io.BytesIO()
+    PILImage.new('RGB', (64, 48), (200, 10, 10)).save(output, format='PNG')
+    return output.getvalue()
+
+
+class StorageTests(unittest.TestCase):
+    def testBackendsImplementEveryOperation(self):
+        class UploadOnlyStorage(Storage):
+            def upload(self, file, image_name):
+                return {"success": False, "message": None}
+
+        with self.assertRaises(TypeError):
+            UploadOnlyStorage()
+
+
+class FileSystemStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.storage = FileSystemStorage(self.directory, '/media')
+        self.image = sample_image()
+        self.app = Flask(__name__)
+
+        @self.app.route('/media/<fileId>')
+        def get_media(fileId):
+            return self.storage.send(fileId)
+
+    def testSameContentIsStoredOnce(self):
+        first = self.storage.upload(io.BytesIO(self.image), 'a.png')
+        second = self.storage.upload(io.BytesIO(self.image), 'b.png')
+        self.assertTrue(first['success'])
+        metadata = first['metadata']
+        self.assertEqual(metadata['fileId'], second['metadata']['fileId'])
+        self.assertEqual((metadata['width'], metadata['height']), (64, 48))
+        self.assertEqual(metadata['url'], '/media/' + metadata['fileId'])
+        with open(self.storage.path(metadata['fileId']), 'rb') as f:
+            self.assertEqual(f.read(), self.image)
+        self.assertEqual(
+            os.listdir(os.path.join(self.directory, 'tmp')), [])
+
+    def testDeleteIsIdempotent(self):
+        fileId = self.storage.upload(
+            io.BytesIO(self.image), 'a.png')['metadata']['fileId']
+        response = self.storage.bulk_delete([fileId, 'f' * 64 + '.png'])
+        self.assertTrue(response['success'])
+        self.assertEqual(len(response['deleted']), 2)
+        self.assertFalse(os.path.exists(self.storage.path(fileId)))
+        self.assertFalse(self.storage.delete('../app.py')['success'])
+
+    def testSendSupportsRangesAndIsCachedForever(self):
+        fileId = self.storage.upload(
+            io.BytesIO(self.image), 'a.png')['metadata']['fileId']
+        client = self.app.test_client()
+        response = client.get('/media/' + fileId)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertEqual(response.get_data(), self.image)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response = client.get(
+            '/media/' + fileId, headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.get_data(), self.image[:10])
+        self.assertEqual(client.get('/media/app.py').status_code, 404)
+
+    def testAccelRedirectLeavesTheBodyToNginx(self):
+        self.storage.accel_redirect = '/protected-media/'
+        fileId = self.storage.upload(
+            io.BytesIO(self.image), 'a.png')['metadata']['fileId']
+        response = self.app.test_client().get('/media/' + fileId)
+        self.assertEqual(
+            response.headers['X-Accel-Redirect'],
+            '/protected-media/{0}/{1}/{2}'.format(
+                fileId[:2], fileId[2:4], fileId))
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(response.mimetype, 'image/png')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,267 @@
+import asyncio
+import random
+import threading
+import time
+from metrics import registry
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+# Throttled and unavailable responses mean the service is in trouble
+RETRYABLE_STATUS = frozenset([429, 500, 502, 503, 504])
+
+HTTP_RETRIES = registry.counter(
+    'http_client_retries_total', 'Retried outgoing requests by service')
+HTTP_REJECTED = registry.counter(
+    'http_client_rejected_total',
+    'Outgoing requests failed fast by an open circuit by service')
+HTTP_CIRCUIT_TRIPS = registry.counter(
+    'http_client_circuit_trips_total', 'Times the circuit opened by service')
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker():
+    '''
+    Opens after failure_threshold consecutive failures and rejects the
+    calls for reset_timeout seconds. Then a single trial call is let
+    through (half open): it closes the circuit if it succeeds and opens
+    it again if it fails.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic,
+                 on_trip=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.on_trip = on_trip
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.trips = 0
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def release_trial(self):
+        '''
+        The call ended without telling whether the service works (e.g. it
+        was cancelled), the next one can be the trial
+        '''
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or \
+                    (self.state == self.CLOSED and
+                     self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+                self.trips += 1
+                if self.on_trip is not None:
+                    self.on_trip()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "trips": self.trips,
+            }
+
+
+class BaseTransport():
+    '''
+    Retries and circuit breaker shared by Transport and AsyncTransport.
+    Only idempotent requests are retried, after connection errors,
+    timeouts and RETRYABLE_STATUS responses, with jittered exponential
+    backoff. When the circuit is open requests raise CircuitOpenError
+    without touching the network. Transports of the same service can
+    share the breaker. requests and httpx are imported when the
+    transports are created.
+    '''
+    def __init__(self, name, connect_timeout, read_timeout, retries,
+                 backoff, backoff_max, pool_size, failure_threshold,
+                 reset_timeout, clock=time.monotonic, breaker=None):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        if breaker is None:
+            breaker = CircuitBreaker(
+                failure_threshold, reset_timeout, clock,
+                on_trip=lambda: HTTP_CIRCUIT_TRIPS.inc(service=name))
+        self.breaker = breaker
+        self.lock = threading.Lock()
+        self.retried = 0
+        self.rejected = 0
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def attempts(self, method, idempotent):
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        return 1 + self.retries if idempotent else 1
+
+    def backoff_delay(self, attempt):
+        '''
+        Full jitter, so the retries of many workers do not synchronize
+        '''
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def retry_delay(self, attempt):
+        self.count('retried')
+        HTTP_RETRIES.inc(service=self.name)
+        return self.backoff_delay(attempt - 1)
+
+    def allow(self):
+        if not self.breaker.allow():
+            self.count('rejected')
+            HTTP_REJECTED.inc(service=self.name)
+            raise CircuitOpenError(
+                "Circuit to {0} is open".format(self.name))
+
+    def stats(self):
+        stats = self.breaker.stats()
+        stats["retries"] = self.retried
+        stats["rejected"] = self.rejected
+        return stats
+
+
+class Transport(BaseTransport):
+    '''
+    requests client with a keep-alive connection pool shared by the
+    threads of the process, and connect and read timeouts
+    '''
+    def __init__(self, *args, sleep=time.sleep, **kwargs):
+        import requests
+        from requests.adapters import HTTPAdapter
+        super().__init__(*args, **kwargs)
+        self.sleep = sleep
+        self.errors = (requests.ConnectionError, requests.Timeout)
+        # Failures of the exchange that are not retried, e.g. a broken
+        # chunked body
+        self.exchange_errors = (requests.RequestException,)
+        self.timeout = (self.connect_timeout, self.read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        '''
+        Same arguments as requests.request, the ones the imagekit SDK
+        passes included. idempotent defaults to the method semantics.
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        attempts = self.attempts(method, idempotent)
+        for attempt in range(attempts):
+            if attempt > 0:
+                self.sleep(self.retry_delay(attempt))
+            self.allow()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except self.errors:
+                self.breaker.record_failure()
+                if attempt == attempts - 1:
+                    raise
+                continue
+            except self.exchange_errors:
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                # Not an answer of the service (reading the uploaded file
+                # failed, the call was cancelled), a trial is released
+                self.breaker.release_trial()
+                raise
+            if response.status_code not in RETRYABLE_STATUS:
+                self.breaker.record_success()
+                return response
+            self.breaker.record_failure()
+            if attempt == attempts - 1:
+                return response
+
+
+class AsyncTransport(BaseTransport):
+    '''
+    httpx client for coroutines, its pool is bound to the event loop it
+    is first used in and must be closed with aclose
+    '''
+    def __init__(self, *args, sleep=None, **kwargs):
+        import httpx
+        super().__init__(*args, **kwargs)
+        self.sleep = sleep or asyncio.sleep
+        self.errors = (httpx.TransportError,)
+        self.exchange_errors = (httpx.HTTPError,)
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                self.read_timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size)
+        )
+
+    async def request(self, method, url, idempotent=None, **kwargs):
+        '''
+        Same arguments as httpx.AsyncClient.request
+        '''
+        attempts = self.attempts(method, idempotent)
+        for attempt in range(attempts):
+            if attempt > 0:
+                await self.sleep(self.retry_delay(attempt))
+            self.allow()
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except self.errors:
+                self.breaker.record_failure()
+                if attempt == attempts - 1:
+                    raise
+                continue
+            except self.exchange_errors:
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                # Not an answer of the service (reading the uploaded file
+                # failed, the call was cancelled), a trial is released
+                self.breaker.release_trial()
+                raise
+            if response.status_code not in RETRYABLE_STATUS:
+                self.breaker.record_success()
+                return response
+            self.breaker.record_failure()
+            if attempt == attempts - 1:
+                return response
+
+    async def aclose(self):
+        await self.client.aclose()
@@ -0,0 +1,141 @@
+import unittest
+import requests
+from requests.adapters import BaseAdapter
+from image_control import ImageKitStorage
+from transport import CircuitBreaker, CircuitOpenError, Transport
+
+
+class ScriptedAdapter(BaseAdapter):
+    '''
+    Answers with the given status codes in order, exceptions are raised
+    '''
+    def __init__(self, outcomes):
+        super().__init__()
+        self.outcomes = list(outcomes)
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append((request, kwargs))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        response.request = request
+        response._content = b'{}'
+        return response
+
+    def close(self):
+        pass
+
+
+class Clock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def transport(outcomes, clock=None, retries=2):
+    delays = []
+    client = Transport('test', 1, 2, retries, 0.1, 1, 4, 3, 30,
+                       sleep=delays.append, clock=clock or Clock())
+    adapter = ScriptedAdapter(outcomes)
+    client.session.mount('http://', adapter)
+    return client, adapter, delays
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def testOpensAndClosesAfterATrial(self):
+        clock = Clock()
+        breaker = CircuitBreaker(2, 30, clock)
+        for _ in range(2):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        clock.now = 30
+        self.assertTrue(breaker.allow())
+        # Only one trial at a time
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.stats()['state'], 'closed')
+        self.assertEqual(breaker.stats()['trips'], 1)
+
+    def testFailedTrialOpensAgain(self):
+        clock = Clock()
+        breaker = CircuitBreaker(1, 30, clock)
+        breaker.allow()
+        breaker.record_failure()
+        clock.now = 31
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.stats()['trips'], 2)
+
+
+class TransportTests(unittest.TestCase):
+    def testIdempotentRequestsAreRetried(self):
+        client, adapter, delays = transport(
+            [503, requests.ConnectionError(), 204])
+        response = client.request('DELETE', 'http://imagekit/v1/files/a')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(len(adapter.requests), 3)
+        self.assertEqual(adapter.requests[0][1]['timeout'], (1, 2))
+        self.assertEqual(client.stats()['retries'], 2)
+        self.assertTrue(0 <= delays[0] <= 0.1 and 0 <= delays[1] <= 0.2)
+        self.assertEqual(client.stats()['state'], 'closed')
+
+    def testOtherRequestsAreNotRetried(self):
+        client, adapter, _ = transport([503])
+        response = client.request('POST', 'http://imagekit/upload')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(adapter.requests), 1)
+
+    def testOpenCircuitFailsFast(self):
+        client, adapter, _ = transport(
+            [requests.Timeout()] * 3, retries=5)
+        with self.assertRaises(CircuitOpenError):
+            client.request('GET', 'http://imagekit/v1/files')
+        self.assertEqual(len(adapter.requests), 3)
+        with self.assertRaises(CircuitOpenError):
+            client.request('GET', 'http://imagekit/v1/files')
+        self.assertEqual(len(adapter.requests), 3)
+        stats = client.stats()
+        self.assertEqual(stats['state'], 'open')
+        self.assertEqual(stats['rejected'], 2)
+
+    def testFailedTrialIsReleased(self):
+        clock = Clock()
+        client, adapter, _ = transport(
+            [requests.ConnectionError()] * 3 +
+            [requests.exceptions.ChunkedEncodingError(), IOError(), 204],
+            clock=clock, retries=0)
+        for _ in range(3):
+            with self.assertRaises(requests.ConnectionError):
+                client.request('GET', 'http://imagekit/v1/files')
+        clock.now = 1000
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            client.request('GET', 'http://imagekit/v1/files')
+        # test the failed trial opened the circuit again instead of
+        # staying in flight
+        clock.now = 2000
+        with self.assertRaises(IOError):
+            client.request('GET', 'http://imagekit/v1/files')
+        response = client.request('GET', 'http://imagekit/v1/files')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(client.stats()['state'], 'closed')
+
+    def testSdkCallsUseTheTransport(self):
+        storage = ImageKitStorage()
+        adapter = ScriptedAdapter([204])
+        storage.transport.session.mount('https://', adapter)
+        self.assertTrue(storage.delete('a')['success'])
+        request, kwargs = adapter.requests[0]
+        self.assertEqual(request.method, 'DELETE')
+        self.assertTrue(request.url.endswith('/v1/files/a'))
+        self.assertIsNotNone(kwargs['timeout'])
+
+
+if __name__ == "__main__":
+    unittest.main()
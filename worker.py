@@ -0,0 +1,144 @@
+import os
+import time
+from datetime import datetime, timedelta
+from app import app, ik, delete_unreferenced_file
+from image_control import BULK_DELETE_MAX_FILES
+from models import db, Album, Image, ImageKitDeletion, UploadJob
+
+NO_ALBUM_FOUND_MESSAGE = "No album found"
+
+WORKER_POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', 1))
+UPLOAD_JOB_MAX_ATTEMPTS = int(os.environ.get('UPLOAD_JOB_MAX_ATTEMPTS', 5))
+# A running job not updated in this time belongs to a dead worker
+UPLOAD_JOB_LEASE_SECONDS = int(os.environ.get('UPLOAD_JOB_LEASE_SECONDS', 600))
+IMAGEKIT_DELETION_MAX_ATTEMPTS = int(
+    os.environ.get('IMAGEKIT_DELETION_MAX_ATTEMPTS', 10))
+
+
+def claim_upload_job():
+    '''
+    Marks as running the oldest job ready to run and returns it, None if
+    there is none. SKIP LOCKED lets many workers drain the queue.
+    '''
+    now = datetime.utcnow()
+    expiredLease = now - timedelta(seconds=UPLOAD_JOB_LEASE_SECONDS)
+    job = UploadJob.query.filter(db.or_(
+        db.and_(
+            UploadJob.status == UploadJob.PENDING,
+            UploadJob.runAfter <= now),
+        db.and_(
+            UploadJob.status == UploadJob.RUNNING,
+            UploadJob.updatedAt < expiredLease),
+    )).order_by(UploadJob.id).with_for_update(skip_locked=True).first()
+    if job is None:
+        db.session.rollback()
+        return None
+    job.status = UploadJob.RUNNING
+    job.attempts += 1
+    job.update()
+    return job
+
+
+def remove_spooled_file(job):
+    try:
+        os.remove(job.path)
+    except FileNotFoundError:
+        pass
+
+
+def process_upload_job(job):
+    try:
+        if Album.query.filter_by(id=job.albumId).first() is None:
+            raise Exception(NO_ALBUM_FOUND_MESSAGE)
+        image = None
+        if job.contentHash is not None:
+            image = Image.find_duplicate(job.contentHash, job.albumId)
+        uploaded = image is None
+        if uploaded:
+            with open(job.path, 'rb') as file:
+                response = ik.upload_file(file, "image.jpeg")
+            if not response['success']:
+                raise Exception(response['message'])
+            image = Image.fromUpload(response, job.albumId, job.contentHash)
+        # An image already in the album (e.g. the same file was enqueued
+        # twice) is the result of the job as it is
+        if image.id is None:
+            db.session.add(image)
+            Album.bump_version(job.albumId)
+            try:
+                db.session.flush()
+            except Exception:
+                db.session.rollback()
+                if uploaded:
+                    delete_unreferenced_file(image.imageKitId)
+                raise
+        job.imageId = image.id
+        job.status = UploadJob.DONE
+        job.error = None
+        job.update()
+        remove_spooled_file(job)
+    except Exception as e:
+        print("\nEXCEPTION process_upload_job", job.id, e, end='\n\n')
+        db.session.rollback()
+        job.error = str(e)
+        if job.attempts >= UPLOAD_JOB_MAX_ATTEMPTS or \
+                e.__str__() == NO_ALBUM_FOUND_MESSAGE:
+            job.status = UploadJob.FAILED
+            remove_spooled_file(job)
+        else:
+            job.status = UploadJob.PENDING
+            job.runAfter = datetime.utcnow() + \
+                timedelta(seconds=2 ** job.attempts)
+        job.update()
+
+
+def process_imagekit_deletions():
+    '''
+    Deletes a batch of queued imagekit files with a single bulk request
+    and returns the size of the batch. The rows stay locked until the
+    batch is done, so other workers skip them and the ones of a dead
+    worker are released. Failed files are retried with backoff.
+    '''
+    now = datetime.utcnow()
+    deletions = ImageKitDeletion.query.filter(
+        ImageKitDeletion.status == ImageKitDeletion.PENDING,
+        ImageKitDeletion.runAfter <= now
+    ).order_by(ImageKitDeletion.id).limit(BULK_DELETE_MAX_FILES)
+    deletions = deletions.with_for_update(skip_locked=True).all()
+    if len(deletions) == 0:
+        db.session.rollback()
+        return 0
+
+    imageKitIds = list({deletion.imageKitId for deletion in deletions})
+    response = ik.bulk_delete_images(imageKitIds)
+    deleted = set(response['deleted'])
+    for deletion in deletions:
+        if deletion.imageKitId in deleted:
+            db.session.delete(deletion)
+            continue
+        deletion.attempts += 1
+        deletion.error = str(response['message'])
+        if deletion.attempts >= IMAGEKIT_DELETION_MAX_ATTEMPTS:
+            deletion.status = ImageKitDeletion.FAILED
+        else:
+            deletion.runAfter = now + timedelta(seconds=2 ** deletion.attempts)
+    db.session.commit()
+    return len(deletions)
+
+
+def run_worker():
+    '''
+    Drains the upload jobs and imagekit deletions queues forever
+    '''
+    with app.app_context():
+        while True:
+            job = claim_upload_job()
+            if job is not None:
+                process_upload_job(job)
+            deletions = process_imagekit_deletions()
+            if job is None and deletions == 0:
+                time.sleep(WORKER_POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    run_worker()